@@ -0,0 +1,69 @@
+"""
+Compare the CPU cost of logging on the message receive path at INFO level.
+
+    python -m benchmarks.bench_logging [--messages 200000]
+
+The eager variant is what ``WechatHandler`` used to do for each text message: build a trace
+f-string with the full message and log two INFO lines. The lazy variant is the current code,
+which passes the message as an argument so that it's only formatted if trace logging is on.
+"""
+import argparse
+import logging
+import os
+import time
+from datetime import datetime
+
+from mautrix.util.logging import TraceLogger
+from wesdk.types import TxtMessage, WechatID
+
+from mautrix_wechat.util.log_sampling import SamplingFilter
+
+
+def _logger() -> TraceLogger:
+    log = logging.getLogger("mau.bench.logging")
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    handler = logging.StreamHandler(open(os.devnull, "w"))
+    handler.setFormatter(logging.Formatter("[%(asctime)s] [%(levelname)s@%(name)s] %(message)s"))
+    handler.addFilter(SamplingFilter())
+    log.addHandler(handler)
+    return log
+
+
+def eager(log: TraceLogger, msg: TxtMessage) -> None:
+    log.trace(f"Received txt message: {msg}")
+    log.info("hi, I'm here")
+    log.info("hihi, I'm here")
+
+
+def lazy(log: TraceLogger, msg: TxtMessage) -> None:
+    log.trace("Received txt message: %s", msg, extra={"sample": "received"})
+
+
+def run(func, log: TraceLogger, msg: TxtMessage, messages: int) -> float:
+    start = time.process_time()
+    for _ in range(messages):
+        func(log, msg)
+    return time.process_time() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    args = parser.parse_args()
+
+    log = _logger()
+    msg = TxtMessage(
+        id="1234567890",
+        source=WechatID("12345678@chatroom"),
+        sender=WechatID("wxid_abcdefghijkl"),
+        time=datetime.now(),
+        content="A typical chat message of moderate length " * 3,
+    )
+    for name, func in (("eager", eager), ("lazy", lazy)):
+        cpu = run(func, log, msg, args.messages)
+        print(f"{name}: {cpu:7.3f}s CPU, {cpu / args.messages * 1e6:6.2f}µs per message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Compare uncached and cached permission lookups with a large permission map.
+
+    python -m benchmarks.bench_permissions [--homeservers 5000] [--users 1000] [--active 2000]
+                                           [--lookups 200000]
+
+The permission map has one entry per homeserver plus one per user on the first homeserver.
+Lookups pick random users out of ``--active`` users spread over all homeservers, including
+ones that aren't in the map, like the users that send messages and commands while the bridge
+runs. The uncached variant is what ``Config.get_permissions`` did before it cached resolved levels.
+"""
+import argparse
+import random
+import time
+from types import MappingProxyType
+
+from mautrix.client import Client
+from mautrix.types import UserID
+
+from mautrix_wechat.config import Config, Permissions
+
+
+class BenchConfig(Config):
+    def __init__(self, permissions: MappingProxyType) -> None:
+        # Only the parts get_permissions uses, without reading a config file
+        self.permissions = permissions
+
+    @property
+    def _permissions(self) -> MappingProxyType:
+        return self.permissions
+
+    def get_permissions_uncached(self, mxid: UserID) -> Permissions:
+        permissions = self._permissions
+        if mxid in permissions:
+            return self._get_permissions(mxid)
+        _, homeserver = Client.parse_user_id(mxid)
+        return self._get_permissions(homeserver if homeserver in permissions else "*")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--homeservers", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--active", type=int, default=2000)
+    parser.add_argument("--lookups", type=int, default=200000)
+    args = parser.parse_args()
+
+    permissions = {"*": "relay"}
+    permissions.update({f"hs{i}.example.com": "user" for i in range(args.homeservers)})
+    permissions.update({f"@user{i}:hs0.example.com": "admin" for i in range(args.users)})
+    config = BenchConfig(MappingProxyType(permissions))
+
+    rng = random.Random(0)
+    active = []
+    for _ in range(args.active):
+        user, homeserver = rng.randrange(args.users), rng.randrange(args.homeservers * 2)
+        active.append(UserID(f"@user{user}:hs{homeserver}.example.com"))
+    mxids = [rng.choice(active) for _ in range(args.lookups)]
+    for name, func in (
+        ("uncached", config.get_permissions_uncached),
+        ("cached", config.get_permissions),
+    ):
+        start = time.perf_counter()
+        for mxid in mxids:
+            func(mxid)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed:7.3f}s, {elapsed / args.lookups * 1e6:6.2f}µs per lookup")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Compare message inserts per second with SQLite's defaults and with the tuned profile.
+
+    python -m benchmarks.bench_sqlite [--messages 2000] [--concurrency 20]
+
+The default setup is a plain connection pool without pragmas, which is what the bridge used
+before ``appservice.sqlite`` existed. The tuned setup applies the pragmas from the example
+config and sends writes through :class:`SQLiteWriteQueue`. Each message is inserted with
+:meth:`Message.insert`, i.e. one statement per message like the bridge does without the
+message buffer.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from mautrix.util.async_db import Database
+
+from mautrix_wechat.db import Message, SQLiteWriteQueue, apply_pragmas, init, upgrade_table
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 268435456,
+    "cache_size": -65536,
+    "busy_timeout": 5000,
+}
+POOL_SIZE = 5
+
+
+async def run(tuned: bool, messages: int, concurrency: int) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database.create(
+            f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+            upgrade_table=upgrade_table,
+            db_args={"min_size": POOL_SIZE, "max_size": POOL_SIZE},
+        )
+        await db.start()
+        if tuned:
+            await apply_pragmas(db, PRAGMAS, POOL_SIZE)
+            init(SQLiteWriteQueue(db))
+        else:
+            init(db)
+        sem = asyncio.Semaphore(concurrency)
+
+        async def insert(i: int) -> None:
+            async with sem:
+                await Message(
+                    mxid=f"$event{i}",
+                    mx_room="!room:example.com",
+                    id=str(i),
+                    sender="wxid_sender",
+                    source="wxid_sender",
+                    receiver="wxid_receiver",
+                    timestamp=i,
+                ).insert()
+
+        try:
+            start = time.perf_counter()
+            await asyncio.gather(*(insert(i) for i in range(messages)))
+            return messages / (time.perf_counter() - start)
+        finally:
+            await db.stop()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    default = await run(False, args.messages, args.concurrency)
+    tuned = await run(True, args.messages, args.concurrency)
+    print(f"default: {default:10.1f} inserts/s")
+    print(f"tuned:   {tuned:10.1f} inserts/s ({tuned / default:.1f}x)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,20 +1,33 @@
-from typing import Any, Dict, List
+import signal
+import asyncio
+from typing import Any, Awaitable, Dict, List
 from collections import defaultdict
 from dataclasses import dataclass
 
 from mautrix.bridge import Bridge
 from mautrix.bridge.state_store.asyncpg import PgBridgeStateStore
 from mautrix.types import RoomID, UserID
-from mautrix.util.async_db import Database
+from mautrix.util.async_db import Database, Scheme
 
 from mautrix_wechat import commands as _
+from mautrix_wechat.cache import CacheEviction
 from mautrix_wechat.version import version
 from mautrix_wechat.config import Config
-from mautrix_wechat.db import upgrade_table, init as init_db
+from mautrix_wechat.db import (
+    upgrade_table,
+    init as init_db,
+    Message as DBMessage,
+    MessageBuffer,
+    SQLiteWriteQueue,
+    apply_pragmas,
+)
 from mautrix_wechat.matrix import MatrixHandler
 from mautrix_wechat.portal import Portal
 from mautrix_wechat.puppet import Puppet
+from mautrix_wechat.retention import MessageRetention
+from mautrix_wechat.routing import RelayRouter
 from mautrix_wechat.user import User
+from mautrix_wechat.util.loop_monitor import LoopMonitor
 from mautrix_wechat.wechat import WechatHandler
 from wesdk.client import WechatClient
 
@@ -41,12 +54,32 @@ class WechatBridge(Bridge):
     db: Database
     matrix: MatrixHandler
     wechat_handlers: List[WechatHandler]
+    retention: MessageRetention
+    relay_router: RelayRouter
+    cache_eviction: CacheEviction
+    loop_monitor: LoopMonitor
     config: Config
     state_store: PgBridgeStateStore
 
     def prepare_db(self) -> None:
         super().prepare_db()
-        init_db(self.db)
+        if self.db.scheme == Scheme.SQLITE and self.config["appservice.sqlite.write_queue.enabled"]:
+            init_db(
+                SQLiteWriteQueue(
+                    self.db, self.config["appservice.sqlite.write_queue.max_batch_size"]
+                )
+            )
+        else:
+            init_db(self.db)
+
+    async def start_db(self) -> None:
+        await super().start_db()
+        if self.db.scheme == Scheme.SQLITE:
+            await apply_pragmas(
+                self.db,
+                self.config["appservice.sqlite.pragmas"],
+                self.config["appservice.database_opts"].get("min_size", 1),
+            )
 
     def prepare_bridge(self) -> None:
         super().prepare_bridge()
@@ -62,11 +95,28 @@ class WechatBridge(Bridge):
         self.log.info("Finished re-sending bridge info state events")
 
     async def start(self) -> None:
+        # Settings read through config.snapshot can be changed without a restart
+        if hasattr(signal, "SIGHUP"):
+            self.loop.add_signal_handler(signal.SIGHUP, self.config.reload)
+        self.loop_monitor = LoopMonitor(
+            self.loop,
+            self.config["metrics.loop_monitor.interval"],
+            self.config["metrics.loop_monitor.stall_threshold"],
+        )
+        if self.config["metrics.loop_monitor.enabled"]:
+            self.loop_monitor.start()
+        if self.config["bridge.message_db_batch.max_size"] > 1:
+            DBMessage.buffer = MessageBuffer(
+                max_size=self.config["bridge.message_db_batch.max_size"],
+                max_delay=self.config["bridge.message_db_batch.max_delay"],
+            )
         User.init_cls(self)
         Portal.init_cls(self)
         Puppet.init_cls(self)
 
         self.wechat_handlers = []
+        self.relay_router = RelayRouter(self.config, self.wechat_handlers)
+        box_actions = []
         for box_config in self.config["wechat.boxes"]:
             admin = box_config.get("admin")
             ip, _, port = box_config.get("address").partition(":")
@@ -80,7 +130,13 @@ class WechatBridge(Bridge):
                 )
                 continue
             handler = WechatHandler(
-                ip, int(port), admin, self, can_relay=can_relay, show_sender=show_sender
+                ip,
+                int(port),
+                admin,
+                self,
+                can_relay=can_relay,
+                show_sender=show_sender,
+                outbound=box_config.get("outbound"),
             )
             self.wechat_handlers.append(handler)
             # TODO: the start method may fail, should handle it
@@ -88,20 +144,48 @@ class WechatBridge(Bridge):
                 if not all(info.get(k) for k in ["wxid", "wxcode", "wxname"]):
                     self.log.warning(f"Not a valid info for manual login: {info}")
                     continue
-                self.add_startup_actions(handler.manual_start(**info))
+                box_actions.append(handler.manual_start(**info))
             else:
-                self.add_startup_actions(handler.start())
+                box_actions.append(handler.start())
+        self.add_startup_actions(self._start_boxes(box_actions))
 
         if self.config["bridge.resend_bridge_info"]:
             self.add_startup_actions(self.resend_bridge_info())
+        self.retention = MessageRetention(self)
+        self.add_startup_actions(self.retention.start())
+        self.cache_eviction = CacheEviction(self)
+        self.cache_eviction.start()
         await super().start()
 
+    async def preload_cache(self) -> None:
+        self.log.debug("Preloading users, puppets and portals")
+        # Puppets go before portals, as DM portals look up their puppet when initialized
+        users = await User.preload()
+        puppets = await Puppet.preload()
+        portals = await Portal.preload()
+        self.log.info(f"Preloaded {users} users, {puppets} puppets and {portals} portals")
+
+    async def _start_boxes(self, actions: List[Awaitable[None]]) -> None:
+        try:
+            await self.preload_cache()
+        except Exception:
+            self.log.exception("Failed to preload cache, objects will be loaded on demand")
+        await asyncio.gather(*actions)
+
     def prepare_stop(self) -> None:
         # self.add_shutdown_actions(user.stop() for user in User.by_mxid.values())
         for puppet in Puppet.by_custom_mxid.values():
             puppet.stop()
-        for handler in self.wechat_handlers:
-            self.add_shutdown_actions(handler.disconnect())
+        self.retention.stop()
+        self.cache_eviction.stop()
+        self.loop_monitor.stop()
+        self.add_shutdown_actions(self._stop_wechat())
+
+    async def _stop_wechat(self) -> None:
+        await asyncio.gather(*(handler.disconnect() for handler in self.wechat_handlers))
+        # Messages can still come in until the boxes are disconnected, flush them afterwards
+        if DBMessage.buffer:
+            await DBMessage.buffer.stop()
 
     async def get_portal(self, room_id: RoomID) -> Portal:
         return await Portal.get_by_mxid(room_id)
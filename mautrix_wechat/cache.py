@@ -0,0 +1,71 @@
+import asyncio
+import logging
+from typing import Optional, TYPE_CHECKING
+
+from mautrix.util.logging import TraceLogger
+from mautrix.util.opt_prometheus import Counter, Gauge
+
+from mautrix_wechat.config import Config
+from mautrix_wechat.portal import Portal
+from mautrix_wechat.puppet import Puppet
+from mautrix_wechat.user import User
+
+if TYPE_CHECKING:
+    from .__main__ import WechatBridge
+
+CACHED_OBJECTS = Gauge(
+    "bridge_cached_objects", "Number of objects held in memory", ["type"]
+)
+EVICTED_OBJECTS = Counter(
+    "bridge_evicted_objects", "Number of idle objects evicted from memory", ["type"]
+)
+CACHED_OBJECTS.labels(type="portal").set_function(lambda: len(Portal.by_wxid))
+CACHED_OBJECTS.labels(type="puppet").set_function(lambda: len(Puppet.by_wxid))
+CACHED_OBJECTS.labels(type="user").set_function(lambda: len(User.by_mxid))
+
+
+class CacheEviction:
+    """
+    Background job that evicts idle portals and puppets from memory.
+
+    Evicted objects are loaded from the database again the next time they're looked up.
+    """
+
+    log: TraceLogger = logging.getLogger("mau.cache")
+    config: Config
+
+    _task: Optional[asyncio.Task]
+
+    def __init__(self, bridge: "WechatBridge") -> None:
+        self.config = bridge.config
+        self.loop = bridge.loop
+        self._task = None
+
+    def start(self) -> None:
+        self._task = self.loop.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        interval = self.config.snapshot.bridge.cache.sweep_interval
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.sweep()
+            except Exception:
+                self.log.exception("Failed to evict idle objects")
+
+    def sweep(self) -> None:
+        cache = self.config.snapshot.bridge.cache
+        portals = Portal.evict_idle(cache.max_idle, cache.max_portals, cache.min_idle)
+        puppets = Puppet.evict_idle(cache.max_idle, cache.max_puppets, cache.min_idle)
+        EVICTED_OBJECTS.labels(type="portal").inc(portals)
+        EVICTED_OBJECTS.labels(type="puppet").inc(puppets)
+        if portals or puppets:
+            self.log.debug(
+                f"Evicted {portals} portals and {puppets} puppets, "
+                f"{len(Portal.by_wxid)} portals and {len(Puppet.by_wxid)} puppets remaining"
+            )
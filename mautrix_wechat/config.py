@@ -1,18 +1,179 @@
 import os
-from typing import Any, List, NamedTuple
+import logging
+from types import MappingProxyType, SimpleNamespace
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional
 
+from ruamel.yaml import YAML, YAMLError
 from mautrix.types import UserID
 from mautrix.client import Client
 from mautrix.bridge.config import (BaseBridgeConfig, ConfigUpdateHelper, ForbiddenDefault)
+from mautrix.util.logging import TraceLogger
 
 Permissions = NamedTuple("Permissions", user=bool, admin=bool, level=str)
+ReloadListener = Callable[["Config"], None]
+
+ENV_PREFIX = "MAUTRIX_WECHAT_"
+
+# Maps keyed by names the user picks (user IDs, domains, pragmas, ...) rather than by the schema.
+# They're always compiled to read-only mappings, even when all their keys are identifiers.
+MAPPING_KEYS = frozenset(
+    {
+        "appservice.database_opts",
+        "appservice.sqlite.pragmas",
+        "bridge.permissions",
+        "bridge.double_puppet_server_map",
+        "bridge.login_shared_secret_map",
+        "logging",
+    }
+)
+
+# Upper bound on cached permission lookups, so unknown users can't grow it forever
+PERMISSION_CACHE_SIZE = 10000
+
+yaml = YAML(typ="safe")
+
+
+def _env_name(key: str) -> str:
+    return f"{ENV_PREFIX}{key.replace('.', '_').upper()}"
+
+
+def _parse_env_value(value: str) -> Any:
+    # Parse overrides like the config file itself, so that e.g. "false" isn't truthy
+    try:
+        return yaml.load(value)
+    except YAMLError:
+        return value
+
+
+class ConfigSnapshot(SimpleNamespace):
+    """
+    Read-only view of the config with environment overrides already applied.
+
+    Sections are attributes (``snapshot.bridge.delivery_receipts``). The maps in
+    :data:`MAPPING_KEYS`, anything inside them or inside lists (like the ``wechat.boxes``
+    entries) and mappings whose keys aren't identifiers are read-only dicts, and lists become
+    tuples.
+    """
+
+    def __setattr__(self, key: str, value: Any) -> None:
+        raise AttributeError("Config snapshots are read-only")
+
+    def __delattr__(self, key: str) -> None:
+        raise AttributeError("Config snapshots are read-only")
+
+    def __getitem__(self, key: str) -> Any:
+        value = self
+        for part in key.split("."):
+            value = getattr(value, part) if isinstance(value, ConfigSnapshot) else value[part]
+        return value
+
+    @classmethod
+    def compile(
+        cls, data: Any, overrides: Dict[str, Any], path: str = "", section: bool = True
+    ) -> Any:
+        if path and _env_name(path) in overrides:
+            return overrides[_env_name(path)]
+        if isinstance(data, dict):
+            section = section and path not in MAPPING_KEYS
+            values = {
+                str(key): cls.compile(
+                    value, overrides, f"{path}.{key}" if path else str(key), section
+                )
+                for key, value in data.items()
+            }
+            if section and all(key.isidentifier() for key in values):
+                return cls(**values)
+            return MappingProxyType(values)
+        if isinstance(data, list):
+            # Indexed paths, so that e.g. MAUTRIX_WECHAT_ADMIN doesn't apply to every box
+            return tuple(
+                cls.compile(value, overrides, f"{path}.{i}", section=False)
+                for i, value in enumerate(data)
+            )
+        return data
+
 
 class Config(BaseBridgeConfig):
+    log: TraceLogger = logging.getLogger("mau.config")
+
+    snapshot: Optional[ConfigSnapshot] = None
+    _env_overrides: Optional[Dict[str, Any]] = None
+    _reload_listeners: Optional[List[ReloadListener]] = None
+    _permission_cache: Optional[Dict[str, Permissions]] = None
+
     def __getitem__(self, key: str) -> Any:
+        if self._env_overrides is None:
+            self._read_env()
+        if self._env_overrides:
+            try:
+                return self._env_overrides[_env_name(key)]
+            except KeyError:
+                pass
+        return super().__getitem__(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        super().__setitem__(key, value)
+        if self.snapshot is not None:
+            self._compile()
+
+    def _read_env(self) -> None:
+        self._env_overrides = {
+            key: _parse_env_value(value)
+            for key, value in os.environ.items()
+            if key.startswith(ENV_PREFIX)
+        }
+
+    def _compile(self) -> None:
+        self.snapshot = ConfigSnapshot.compile(self._data, self._env_overrides or {})
+        self._permission_cache = {}
+
+    def load(self) -> None:
+        super().load()
+        self._read_env()
+        self._compile()
+
+    def update(self, save: bool = True) -> None:
+        super().update(save)
+        self._compile()
+        self._validate()
+
+    def _validate(self) -> None:
+        rate_limit = self.snapshot.bridge.puppet_profile_refresh.rate_limit
+        if not isinstance(rate_limit, (int, float)) or rate_limit < 0:
+            raise ValueError(
+                "bridge.puppet_profile_refresh.rate_limit must be a number that is 0 or more, "
+                f"got {rate_limit!r}"
+            )
+
+    def add_reload_listener(self, listener: ReloadListener) -> None:
+        if self._reload_listeners is None:
+            self._reload_listeners = []
+        self._reload_listeners.append(listener)
+
+    def reload(self) -> bool:
+        """
+        Read the config file and environment again and swap in a new snapshot.
+
+        Objects that copied config values when they were created keep the old values unless they
+        registered a listener with :meth:`add_reload_listener`, so this mostly affects settings
+        that are read from :attr:`snapshot` when they're used.
+        """
+        old_data, old_env = self._data, self._env_overrides
         try:
-            return os.environ[f"MAUTRIX_WECHAT_{key.replace('.', '_').upper()}"]
-        except KeyError:
-            return super().__getitem__(key)
+            self.load()
+            self.update(save=False)
+        except Exception:
+            self.log.exception("Failed to reload config, keeping the current one")
+            self._data, self._env_overrides = old_data, old_env
+            self._compile()
+            return False
+        for listener in self._reload_listeners or []:
+            try:
+                listener(self)
+            except Exception:
+                self.log.exception("Error in config reload listener")
+        self.log.info("Reloaded config")
+        return True
 
     @property
     def forbidden_defaults(self) -> List[ForbiddenDefault]:
@@ -29,10 +190,27 @@ class Config(BaseBridgeConfig):
 
         copy("homeserver.asmux")
 
+        copy_dict("appservice.sqlite.pragmas")
+        copy("appservice.sqlite.write_queue.enabled")
+        copy("appservice.sqlite.write_queue.max_batch_size")
+
         copy("wechat.boxes")
+        copy("wechat.outbound.rate")
+        copy("wechat.outbound.burst")
+        copy("wechat.outbound.max_retries")
+        copy("wechat.outbound.retry_delay")
+        copy("wechat.outbound.batch_size")
+        copy("wechat.outbound.coalesce_window")
+        copy("wechat.outbound.coalesce_max_messages")
+        copy("wechat.outbound.coalesce_max_length")
+        copy("wechat.relay_routing.enabled")
+        copy("wechat.relay_routing.stickiness")
 
         copy("metrics.enabled")
         copy("metrics.listen_port")
+        copy("metrics.loop_monitor.enabled")
+        copy("metrics.loop_monitor.interval")
+        copy("metrics.loop_monitor.stall_threshold")
 
         copy("bridge.username_template")
         copy("bridge.displayname_template")
@@ -67,6 +245,32 @@ class Config(BaseBridgeConfig):
         copy("bridge.backfill.missed_event_limit")
         copy("bridge.backfill.missed_event_page_size")
         copy("bridge.backfill.disable_notifications")
+        copy("bridge.backfill.missed_message_age")
+        copy("bridge.message_dedup.window_size")
+        copy("bridge.message_dedup.bloom_filter_capacity")
+        copy("bridge.message_dedup.bloom_filter_error_rate")
+        copy("bridge.message_db_batch.max_size")
+        copy("bridge.message_db_batch.max_delay")
+        copy("bridge.message_pipeline.max_concurrent")
+        copy("bridge.cross_box_dedup.enabled")
+        copy("bridge.cross_box_dedup.max_entries")
+        copy("bridge.cross_box_dedup.ttl")
+        copy("bridge.message_retention.max_age")
+        copy("bridge.message_retention.prune_interval")
+        copy("bridge.message_retention.prune_batch_size")
+        copy("bridge.message_retention.prune_batch_delay")
+        copy("bridge.message_retention.partition_by_month")
+        copy("bridge.cache.max_idle")
+        copy("bridge.cache.max_portals")
+        copy("bridge.cache.max_puppets")
+        copy("bridge.cache.min_idle")
+        copy("bridge.cache.sweep_interval")
+        copy("bridge.contact_sync_interval")
+        copy("bridge.room_provisioning.strategy")
+        copy("bridge.room_provisioning.concurrency")
+        copy("bridge.room_provisioning.delay")
+        copy("bridge.puppet_profile_refresh.interval")
+        copy("bridge.puppet_profile_refresh.rate_limit")
         copy("bridge.resend_bridge_info")
         copy("bridge.unimportant_bridge_notices")
         copy("bridge.disable_bridge_notices")
@@ -82,18 +286,36 @@ class Config(BaseBridgeConfig):
         copy_dict("bridge.permissions")
 
     def _get_permissions(self, key: str) -> Permissions:
-        level = self["bridge.permissions"].get(key, "")
+        level = self._permissions.get(key, "")
         admin = level == "admin"
         user = level == "user" or admin
         return Permissions(user, admin, level)
 
-    def get_permissions(self, mxid: UserID) -> Permissions:
-        permissions = self["bridge.permissions"]
-        if mxid in permissions:
-            return self._get_permissions(mxid)
+    @property
+    def _permissions(self) -> Mapping[str, str]:
+        if self.snapshot is None:
+            return self["bridge.permissions"]
+        return self.snapshot.bridge.permissions
 
-        _, homeserver = Client.parse_user_id(mxid)
-        if homeserver in permissions:
-            return self._get_permissions(homeserver)
+    def get_permissions(self, mxid: UserID) -> Permissions:
+        # Resolved levels are cached per user and per homeserver until the config changes
+        cache = self._permission_cache
+        if cache is None or len(cache) >= PERMISSION_CACHE_SIZE:
+            cache = self._permission_cache = {}
+        try:
+            return cache[mxid]
+        except KeyError:
+            pass
 
-        return self._get_permissions("*")
\ No newline at end of file
+        permissions = self._permissions
+        if mxid in permissions:
+            resolved = self._get_permissions(mxid)
+        else:
+            _, homeserver = Client.parse_user_id(mxid)
+            try:
+                resolved = cache[homeserver]
+            except KeyError:
+                key = homeserver if homeserver in permissions else "*"
+                resolved = cache[homeserver] = self._get_permissions(key)
+        cache[mxid] = resolved
+        return resolved
@@ -5,11 +5,15 @@ from mautrix_wechat.db.user import User
 from mautrix_wechat.db.puppet import Puppet
 from mautrix_wechat.db.portal import Portal
 from mautrix_wechat.db.message import Message
+from mautrix_wechat.db.message_buffer import MessageBuffer
+from mautrix_wechat.db.outbound import OutboundMessage
+from mautrix_wechat.db.sqlite import SQLiteWriteQueue, apply_pragmas
 
 
 def init(db: Database) -> None:
-    for table in (User, Puppet, Portal, Message):
+    for table in (User, Puppet, Portal, Message, OutboundMessage):
         table.db = db
 
 
-__all__ = ["upgrade_table", "init", "User", "Puppet", "Portal", "Message",]
\ No newline at end of file
+__all__ = ["upgrade_table", "init", "User", "Puppet", "Portal", "Message", "MessageBuffer",
+           "OutboundMessage", "SQLiteWriteQueue", "apply_pragmas",]
\ No newline at end of file
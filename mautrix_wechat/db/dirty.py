@@ -0,0 +1,35 @@
+from typing import Any, ClassVar, FrozenSet, List, Set
+
+
+class DirtyTracking:
+    """
+    Mixin for attrs models that records which columns changed since the row was last written.
+
+    Subclasses list their non-key columns in ``_tracked_columns``. Assignments made while the
+    object is being constructed (e.g. when loading a row) are not tracked.
+    """
+
+    _tracked_columns: ClassVar[FrozenSet[str]] = frozenset()
+    _dirty: Set[str]
+
+    def __attrs_post_init__(self) -> None:
+        object.__setattr__(self, "_dirty", set())
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name in self._tracked_columns:
+            dirty = self.__dict__.get("_dirty")
+            if dirty is not None and (name not in self.__dict__ or self.__dict__[name] != value):
+                dirty.add(name)
+        super().__setattr__(name, value)
+
+    @property
+    def is_dirty(self) -> bool:
+        return bool(self._dirty)
+
+    def _take_dirty(self) -> List[str]:
+        """Return the changed columns in a stable order and mark the object as clean."""
+        dirty, self._dirty = self._dirty, set()
+        return sorted(dirty)
+
+    def _restore_dirty(self, columns: List[str]) -> None:
+        self._dirty.update(columns)
@@ -1,19 +1,86 @@
 from uuid import UUID
-from typing import Optional, ClassVar, Union, List, TYPE_CHECKING
+from itertools import chain
+from datetime import datetime, timezone
+from typing import Any, Optional, ClassVar, Union, List, Tuple, TYPE_CHECKING
 
 import asyncpg
 from attr import dataclass
 
 from mautrix.types import RoomID, EventID
-from mautrix.util.async_db import Database
+from mautrix.util.async_db import Database, Scheme
 from wesdk.types import WechatID
 
+if TYPE_CHECKING:
+    from mautrix_wechat.db.message_buffer import MessageBuffer
+
 fake_db = Database("") if TYPE_CHECKING else None
 
+# Older SQLite builds cap the number of host parameters in a statement at 999
+SQLITE_MAX_PARAMS = 999
+SQLITE_MAX_ROWS_PER_INSERT = SQLITE_MAX_PARAMS // 7
+
+MESSAGE_TABLE_COLUMNS = """
+        mxid    TEXT NOT NULL,
+        mx_room TEXT NOT NULL,
+        id              TEXT,
+        sender          TEXT,
+        source          TEXT,
+        receiver        TEXT,
+        timestamp       BIGINT,
+        PRIMARY KEY (sender, source, receiver, timestamp),
+        FOREIGN KEY (source, receiver) REFERENCES portal(wxid, receiver)
+            ON UPDATE CASCADE ON DELETE CASCADE
+"""
+
+
+def _affected_rows(result: Any) -> int:
+    # asyncpg returns a status string like "DELETE 42", aiosqlite returns a cursor
+    if isinstance(result, str):
+        return int(result.rsplit(" ", 1)[-1])
+    return result.rowcount
+
+
+def _month_start(ts: int) -> datetime:
+    return datetime.fromtimestamp(ts, timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+
+
+def _next_month(month: datetime) -> datetime:
+    if month.month == 12:
+        return month.replace(year=month.year + 1, month=1)
+    return month.replace(month=month.month + 1)
+
 
 @dataclass
 class Message:
     db: ClassVar[Database] = fake_db
+    buffer: ClassVar[Optional["MessageBuffer"]] = None
+    columns: ClassVar[Tuple[str, ...]] = (
+        "mxid", "mx_room", "id", "sender", "source", "receiver", "timestamp"
+    )
+
+    # Lookup queries, kept here so tests can check that they're served by an index
+    _select: ClassVar[str] = (
+        "SELECT mxid, mx_room, id, sender, source, receiver, timestamp FROM message "
+    )
+    get_by_mxid_query: ClassVar[str] = _select + "WHERE mxid=$1"
+    get_by_wechat_id_query: ClassVar[str] = (
+        _select + "WHERE sender=$1 AND source=$2 AND receiver=$3 AND timestamp=$4"
+    )
+    get_last_query: ClassVar[str] = (
+        _select + "WHERE mx_room=$1 ORDER BY timestamp DESC LIMIT 1"
+    )
+    get_last_before_query: ClassVar[str] = (
+        _select + "WHERE mx_room=$1 AND timestamp<=$2 ORDER BY timestamp DESC LIMIT 1"
+    )
+    find_by_sender_content_query: ClassVar[str] = _select + "WHERE sender=$1 AND timestamp=$2"
+    prune_query: ClassVar[str] = (
+        "DELETE FROM message WHERE (sender, source, receiver, timestamp) IN ("
+        "    SELECT sender, source, receiver, timestamp FROM message"
+        "    WHERE timestamp<$1 LIMIT $2"
+        ")"
+    )
 
     mxid: EventID
     mx_room: RoomID
@@ -39,7 +106,62 @@ class Message:
             self.timestamp,
         )
 
+    async def insert_batched(self) -> None:
+        if self.buffer:
+            self.buffer.add(self)
+        else:
+            await self.insert()
+
+    @property
+    def _values(self) -> Tuple:
+        return (
+            self.mxid,
+            self.mx_room,
+            self.id,
+            self.sender,
+            self.source,
+            self.receiver,
+            self.timestamp,
+        )
+
+    @classmethod
+    async def insert_many(cls, messages: List["Message"]) -> None:
+        if not messages:
+            return
+        records = [msg._values for msg in messages]
+        if cls.db.scheme == Scheme.SQLITE:
+            for i in range(0, len(records), SQLITE_MAX_ROWS_PER_INSERT):
+                chunk = records[i : i + SQLITE_MAX_ROWS_PER_INSERT]
+                values = ", ".join(
+                    "(" + ", ".join(f"${n * 7 + c}" for c in range(1, 8)) + ")"
+                    for n in range(len(chunk))
+                )
+                q = (
+                    f"INSERT INTO message ({', '.join(cls.columns)}) VALUES {values} "
+                    "ON CONFLICT DO NOTHING"
+                )
+                await cls.db.execute(q, *chain.from_iterable(chunk))
+            return
+
+        q = (
+            f"INSERT INTO message ({', '.join(cls.columns)}) "
+            "VALUES ($1, $2, $3, $4, $5, $6, $7) ON CONFLICT DO NOTHING"
+        )
+        async with cls.db.acquire() as conn:
+            if cls.db.scheme == Scheme.POSTGRES:
+                try:
+                    await conn.copy_records_to_table(
+                        "message", records=records, columns=cls.columns
+                    )
+                    return
+                except asyncpg.UniqueViolationError:
+                    # COPY is all-or-nothing, retry row by row and skip the duplicates
+                    pass
+            await conn.executemany(q, records)
+
     async def delete(self) -> None:
+        if self.buffer:
+            self.buffer.discard(self)
         q = (
             "DELETE FROM message WHERE sender=$1 AND source=$2"
             "                          AND receiver=$3 AND timestamp=$4"
@@ -50,8 +172,87 @@ class Message:
 
     @classmethod
     async def delete_all(cls, room_id: RoomID) -> None:
+        if cls.buffer:
+            cls.buffer.discard_room(room_id)
         await cls.db.execute("DELETE FROM message WHERE mx_room=$1", room_id)
 
+    @classmethod
+    async def prune(cls, before: int, limit: int) -> int:
+        return _affected_rows(await cls.db.execute(cls.prune_query, before, limit))
+
+    @classmethod
+    async def is_partitioned(cls) -> bool:
+        if cls.db.scheme != Scheme.POSTGRES:
+            return False
+        q = (
+            "SELECT EXISTS(SELECT 1 FROM pg_partitioned_table "
+            "              WHERE partrelid='message'::regclass)"
+        )
+        return await cls.db.fetchval(q)
+
+    @classmethod
+    async def partition_by_month(cls) -> None:
+        """Convert the message table into a table range-partitioned by month (Postgres only)."""
+        async with cls.db.acquire() as conn, conn.transaction():
+            await conn.execute("ALTER TABLE message RENAME TO message_unpartitioned")
+            await conn.execute(
+                f"CREATE TABLE message ({MESSAGE_TABLE_COLUMNS}) PARTITION BY RANGE (timestamp)"
+            )
+            await conn.execute("CREATE TABLE message_default PARTITION OF message DEFAULT")
+            oldest = await conn.fetchval("SELECT MIN(timestamp) FROM message_unpartitioned")
+            month = _month_start(oldest) if oldest is not None else None
+            last = _next_month(_month_start(int(datetime.now(timezone.utc).timestamp())))
+            while month is not None and month <= last:
+                await cls._create_month_partition(conn, month)
+                month = _next_month(month)
+            await conn.execute(
+                f"INSERT INTO message ({', '.join(cls.columns)}) "
+                f"SELECT {', '.join(cls.columns)} FROM message_unpartitioned"
+            )
+            await conn.execute("DROP TABLE message_unpartitioned")
+            # Unique indexes on partitioned tables must contain the partition key
+            await conn.execute("CREATE INDEX message_mxid_idx ON message (mxid, mx_room)")
+            await conn.execute("CREATE INDEX message_timestamp_idx ON message (timestamp)")
+            await conn.execute(
+                "CREATE INDEX message_sender_timestamp_idx ON message (sender, timestamp)"
+            )
+            await conn.execute("CREATE INDEX message_id_idx ON message (id)")
+            await conn.execute(
+                "CREATE INDEX message_mx_room_timestamp_idx ON message (mx_room, timestamp)"
+            )
+
+    @staticmethod
+    async def _create_month_partition(conn: Any, month: datetime) -> None:
+        await conn.execute(
+            f"CREATE TABLE IF NOT EXISTS message_p{month:%Y%m} PARTITION OF message "
+            f"FOR VALUES FROM ({int(month.timestamp())}) "
+            f"TO ({int(_next_month(month).timestamp())})"
+        )
+
+    @classmethod
+    async def ensure_month_partitions(cls, now: int) -> None:
+        current = _month_start(now)
+        async with cls.db.acquire() as conn:
+            for month in (current, _next_month(current)):
+                await cls._create_month_partition(conn, month)
+
+    @classmethod
+    async def drop_partitions_before(cls, before: int) -> List[str]:
+        """Drop the monthly partitions that only contain rows older than ``before``."""
+        q = (
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid=pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent='message'::regclass AND child.relname LIKE 'message_p%'"
+        )
+        dropped = []
+        for name in sorted(row["relname"] for row in await cls.db.fetch(q)):
+            month = datetime.strptime(name[len("message_p"):], "%Y%m").replace(tzinfo=timezone.utc)
+            if _next_month(month).timestamp() > before:
+                break
+            await cls.db.execute(f"DROP TABLE {name}")
+            dropped.append(name)
+        return dropped
+
     @classmethod
     def _from_row(cls, row: asyncpg.Record) -> "Message":
         data = {**row}
@@ -60,11 +261,9 @@ class Message:
 
     @classmethod
     async def get_by_mxid(cls, mxid: EventID) -> Optional["Message"]:
-        q = (
-            "SELECT mxid, mx_room, id, sender, source, receiver, timestamp "
-            "FROM message WHERE mxid=$1"
-        )
-        row = await cls.db.fetchrow(q, mxid)
+        if cls.buffer and (pending := cls.buffer.get_by_mxid(mxid)):
+            return pending
+        row = await cls.db.fetchrow(cls.get_by_mxid_query, mxid)
         if not row:
             return None
         return cls(**row)
@@ -73,33 +272,66 @@ class Message:
     async def get_by_wechat_id(
         cls, sender: WechatID, source: WechatID, receiver: WechatID, timestamp: int
     ) -> Optional["Message"]:
-        q = (
-            "SELECT mxid, mx_room, id, sender, source, receiver, timestamp "
-            "FROM message WHERE sender=$1 AND source=$2 AND receiver=$3 AND timestamp=$4"
+        if cls.buffer and (
+            pending := cls.buffer.get_by_wechat_id(sender, source, receiver, timestamp)
+        ):
+            return pending
+        row = await cls.db.fetchrow(
+            cls.get_by_wechat_id_query, sender, source, receiver, timestamp
         )
-        row = await cls.db.fetchrow(q, sender, source, receiver, timestamp)
         if not row:
             return None
         return cls(**row)
 
+    @classmethod
+    async def get_last(
+        cls, mx_room: RoomID, before: Optional[int] = None
+    ) -> Optional["Message"]:
+        """Get the newest message in the room, or the newest one sent at or before ``before``."""
+        if before is None:
+            row = await cls.db.fetchrow(cls.get_last_query, mx_room)
+        else:
+            row = await cls.db.fetchrow(cls.get_last_before_query, mx_room, before)
+        last = cls(**row) if row else None
+        if cls.buffer and (pending := cls.buffer.get_last(mx_room, before)):
+            if not last or pending.timestamp >= last.timestamp:
+                return pending
+        return last
+
+    @classmethod
+    def find_by_timestamps_query(cls, scheme: Scheme, count: int) -> str:
+        if scheme == Scheme.POSTGRES:
+            return cls._select + "WHERE timestamp=ANY($1)"
+        # SQLite has no arrays
+        return cls._select + f"WHERE timestamp IN ({', '.join(f'${i + 1}' for i in range(count))})"
+
     @classmethod
     async def find_by_timestamps(cls, timestamps: List[int]) -> List["Message"]:
-        q = (
-            "SELECT mxid, mx_room, id, sender, source, receiver, timestamp "
-            "FROM message WHERE timestamp=ANY($1)"
-        )
-        rows = await cls.db.fetch(q, timestamps)
-        return [cls(**row) for row in rows]
+        if cls.db.scheme == Scheme.POSTGRES:
+            rows = await cls.db.fetch(cls.find_by_timestamps_query(Scheme.POSTGRES, 1), timestamps)
+        else:
+            rows = []
+            for i in range(0, len(timestamps), SQLITE_MAX_PARAMS):
+                chunk = timestamps[i : i + SQLITE_MAX_PARAMS]
+                q = cls.find_by_timestamps_query(cls.db.scheme, len(chunk))
+                rows += await cls.db.fetch(q, *chunk)
+        messages = [cls(**row) for row in rows]
+        if cls.buffer:
+            flushed = {msg.mxid for msg in messages}
+            messages += [
+                msg
+                for msg in cls.buffer.find_by_timestamps(timestamps)
+                if msg.mxid not in flushed
+            ]
+        return messages
 
     @classmethod
     async def find_by_sender_content(
         cls, sender: WechatID, timestamp: int
     ) -> Optional["Message"]:
-        q = (
-            "SELECT mxid, mx_room, id, sender, source, receiver, timestamp "
-            "FROM message WHERE sender=$1 AND timestamp=$2"
-        )
-        row = await cls.db.fetchrow(q, sender, timestamp)
+        if cls.buffer and (pending := cls.buffer.find_by_sender_content(sender, timestamp)):
+            return pending
+        row = await cls.db.fetchrow(cls.find_by_sender_content_query, sender, timestamp)
         if not row:
             return None
         return cls(**row)
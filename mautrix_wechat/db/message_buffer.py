@@ -0,0 +1,171 @@
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from mautrix.types import EventID, RoomID
+from mautrix.util.logging import TraceLogger
+from mautrix.util.opt_prometheus import Counter, Gauge, Histogram
+from wesdk.types import WechatID
+
+from mautrix_wechat.db.message import Message
+
+MessageKey = Tuple[WechatID, WechatID, WechatID, int]
+
+FLUSH_TIME = Histogram("bridge_message_db_flush_seconds", "Time spent writing a message batch")
+PENDING_MESSAGES = Gauge("bridge_message_db_pending", "Message mappings waiting to be written")
+DROPPED_MESSAGES = Counter(
+    "bridge_message_db_dropped", "Message mappings dropped because they couldn't be written"
+)
+
+# Failed batch writes are retried this many times before rows are written one by one
+MAX_FLUSH_RETRIES = 3
+
+
+class MessageBuffer:
+    """
+    Write-behind buffer for message mappings.
+
+    Rows are kept in memory until ``max_size`` rows are pending or ``max_delay`` seconds have
+    passed since the first pending row, and are then written with a single
+    :meth:`Message.insert_many` call. Pending rows stay visible to the lookup methods until
+    they have been flushed successfully. A batch that keeps failing is written row by row
+    after :data:`MAX_FLUSH_RETRIES` retries, and the rows that still fail are dropped, so one
+    bad row can't hold up everything after it.
+    """
+
+    log: TraceLogger = logging.getLogger("mau.db.message_buffer")
+
+    max_size: int
+    max_delay: float
+    _pending: Dict[MessageKey, Message]
+    _by_mxid: Dict[EventID, Message]
+    _flush_lock: asyncio.Lock
+    _flush_tasks: Set[asyncio.Task]
+    _timer: Optional[asyncio.TimerHandle]
+
+    def __init__(self, max_size: int = 100, max_delay: float = 0.5) -> None:
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._pending = {}
+        self._by_mxid = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_tasks = set()
+        self._failures = 0
+        self._timer = None
+        PENDING_MESSAGES.set_function(lambda: len(self._pending))
+
+    @staticmethod
+    def _key(msg: Message) -> MessageKey:
+        return msg.sender, msg.source, msg.receiver, msg.timestamp
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, msg: Message) -> None:
+        self._pending[self._key(msg)] = msg
+        self._by_mxid[msg.mxid] = msg
+        if len(self._pending) >= self.max_size:
+            self._schedule_flush()
+        elif not self._timer:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_delay, self._schedule_flush
+            )
+
+    def _schedule_flush(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        task = asyncio.create_task(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    def _remove(self, messages: Iterable[Message]) -> None:
+        for msg in messages:
+            key = self._key(msg)
+            if self._pending.get(key) is msg:
+                del self._pending[key]
+            if self._by_mxid.get(msg.mxid) is msg:
+                del self._by_mxid[msg.mxid]
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            batch = list(self._pending.values())
+            if not batch:
+                return
+            try:
+                with FLUSH_TIME.time():
+                    await Message.insert_many(batch)
+            except Exception:
+                self._failures += 1
+                if self._failures <= MAX_FLUSH_RETRIES:
+                    self.log.exception(
+                        f"Failed to flush {len(batch)} messages, "
+                        f"retrying in {self.max_delay} seconds"
+                    )
+                    self._timer = asyncio.get_running_loop().call_later(
+                        self.max_delay, self._schedule_flush
+                    )
+                    return
+                self.log.exception(f"Failed to flush {len(batch)} messages, writing one by one")
+                await self._insert_each(batch)
+            else:
+                self.log.trace(f"Flushed {len(batch)} messages")
+            self._failures = 0
+            self._remove(batch)
+
+    async def _insert_each(self, batch: List[Message]) -> None:
+        for msg in batch:
+            try:
+                await Message.insert_many([msg])
+            except Exception as e:
+                DROPPED_MESSAGES.inc()
+                self.log.warning(f"Dropping message mapping {msg.mxid} in {msg.mx_room}: {e}")
+
+    async def stop(self) -> None:
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+        await self.flush()
+        if self._pending:
+            self.log.warning(f"Dropping {len(self._pending)} unflushed messages on shutdown")
+
+    def discard(self, msg: Message) -> None:
+        self._remove([msg])
+
+    def discard_room(self, room_id: RoomID) -> None:
+        self._remove([msg for msg in self._pending.values() if msg.mx_room == room_id])
+
+    def get_by_mxid(self, mxid: EventID) -> Optional[Message]:
+        return self._by_mxid.get(mxid)
+
+    def get_by_wechat_id(
+        self, sender: WechatID, source: WechatID, receiver: WechatID, timestamp: int
+    ) -> Optional[Message]:
+        return self._pending.get((sender, source, receiver, timestamp))
+
+    def get_last(self, room_id: RoomID, before: Optional[int] = None) -> Optional[Message]:
+        return max(
+            (
+                msg
+                for msg in self._pending.values()
+                if msg.mx_room == room_id and (before is None or msg.timestamp <= before)
+            ),
+            key=lambda msg: msg.timestamp,
+            default=None,
+        )
+
+    def find_by_timestamps(self, timestamps: List[int]) -> List[Message]:
+        timestamps = set(timestamps)
+        return [msg for msg in self._pending.values() if msg.timestamp in timestamps]
+
+    def find_by_sender_content(self, sender: WechatID, timestamp: int) -> Optional[Message]:
+        return next(
+            (
+                msg
+                for msg in self._pending.values()
+                if msg.sender == sender and msg.timestamp == timestamp
+            ),
+            None,
+        )
@@ -0,0 +1,74 @@
+from typing import Optional, ClassVar, List, TYPE_CHECKING
+
+from attr import dataclass
+
+from mautrix.types import RoomID, EventID, UserID
+from mautrix.util.async_db import Database
+from wesdk.types import WechatID
+
+from mautrix_wechat.db.message import _affected_rows
+
+fake_db = Database("") if TYPE_CHECKING else None
+
+
+@dataclass
+class OutboundMessage:
+    """Journal entry for a Matrix message that is queued to be sent to WeChat."""
+
+    db: ClassVar[Database] = fake_db
+
+    event_id: EventID
+    mx_room: RoomID
+    box: str
+    sender: UserID
+    wxid: WechatID
+    receiver: WechatID
+    text: str
+    nickname: Optional[str]
+    priority: int
+    queued_at: int
+    finished_at: Optional[int] = None
+
+    async def insert(self) -> bool:
+        """Add the message to the journal, unless the event is already in it."""
+        q = (
+            "INSERT INTO outbound_message (event_id, mx_room, box, sender, wxid, receiver, text, "
+            "                              nickname, priority, queued_at) "
+            "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10) ON CONFLICT (event_id) DO NOTHING"
+        )
+        result = await self.db.execute(
+            q,
+            self.event_id,
+            self.mx_room,
+            self.box,
+            self.sender,
+            self.wxid,
+            self.receiver,
+            self.text,
+            self.nickname,
+            self.priority,
+            self.queued_at,
+        )
+        return _affected_rows(result) > 0
+
+    @classmethod
+    async def mark_finished(cls, event_id: EventID, finished_at: int) -> None:
+        q = "UPDATE outbound_message SET finished_at=$2 WHERE event_id=$1"
+        await cls.db.execute(q, event_id, finished_at)
+
+    @classmethod
+    async def get_pending(cls, box: str, limit: int) -> List["OutboundMessage"]:
+        q = (
+            "SELECT event_id, mx_room, box, sender, wxid, receiver, text, nickname, priority, "
+            "       queued_at, finished_at "
+            "FROM outbound_message WHERE box=$1 AND finished_at IS NULL "
+            "ORDER BY priority, queued_at, event_id LIMIT $2"
+        )
+        rows = await cls.db.fetch(q, box, limit)
+        return [cls(**row) for row in rows]
+
+    @classmethod
+    async def prune(cls, before: int) -> int:
+        # Finished entries are kept for a while to recognize events that are delivered again
+        q = "DELETE FROM outbound_message WHERE finished_at IS NOT NULL AND finished_at<$1"
+        return _affected_rows(await cls.db.execute(q, before))
@@ -1,5 +1,5 @@
 from uuid import UUID
-from typing import Optional, ClassVar, List, Union, TYPE_CHECKING
+from typing import Optional, ClassVar, FrozenSet, List, Union, TYPE_CHECKING
 
 import asyncpg
 from attr import dataclass
@@ -9,12 +9,17 @@ from mautrix.types.primitive import ContentURI
 from mautrix.util.async_db import Database
 from wesdk.types import WechatID
 
+from mautrix_wechat.db.dirty import DirtyTracking
+
 fake_db = Database("") if TYPE_CHECKING else None
 
 
 @dataclass
-class Portal:
+class Portal(DirtyTracking):
     db: ClassVar[Database] = fake_db
+    _tracked_columns: ClassVar[FrozenSet[str]] = frozenset(
+        ("mxid", "name", "avatar_url", "encrypted")
+    )
 
     wxid: WechatID
     receiver: WechatID
@@ -28,30 +33,67 @@ class Portal:
             "INSERT INTO portal (wxid, receiver, mxid, name, avatar_url, encrypted) "
             "VALUES ($1, $2, $3, $4, $5, $6)"
         )
-        await self.db.execute(
-            q,
-            self.wxid,
-            self.receiver,
-            self.mxid,
-            self.name,
-            self.avatar_url,
-            self.encrypted,
-        )
+        # Changes made while the write is in flight stay dirty
+        columns = self._take_dirty()
+        try:
+            await self.db.execute(
+                q,
+                self.wxid,
+                self.receiver,
+                self.mxid,
+                self.name,
+                self.avatar_url,
+                self.encrypted,
+            )
+        except Exception:
+            self._restore_dirty(columns)
+            raise
 
     async def save(self) -> None:
+        columns = self._take_dirty()
+        if not columns:
+            return
+        updates = ", ".join(f"{column}=${i}" for i, column in enumerate(columns, start=3))
+        q = f"UPDATE portal SET {updates} WHERE wxid=$1 and receiver=$2"
+        try:
+            await self.db.execute(
+                q, self.wxid, self.receiver, *(getattr(self, column) for column in columns)
+            )
+        except Exception:
+            self._restore_dirty(columns)
+            raise
+
+    @classmethod
+    async def bulk_upsert(cls, portals: List["Portal"]) -> None:
+        if not portals:
+            return
         q = (
-            "UPDATE portal SET mxid=$3, name=$4, avatar_url=$5, encrypted=$6 "
-            "WHERE wxid=$1 and receiver=$2"
-        )
-        await self.db.execute(
-            q,
-            self.wxid,
-            self.receiver,
-            self.mxid,
-            self.name,
-            self.avatar_url,
-            self.encrypted,
+            "INSERT INTO portal (wxid, receiver, mxid, name, avatar_url, encrypted) "
+            "VALUES ($1, $2, $3, $4, $5, $6) "
+            "ON CONFLICT (wxid, receiver) DO UPDATE SET "
+            "    mxid=excluded.mxid, name=excluded.name, avatar_url=excluded.avatar_url, "
+            "    encrypted=excluded.encrypted"
         )
+        dirty = [(portal, portal._take_dirty()) for portal in portals]
+        try:
+            await cls.db.executemany(
+                q,
+                [
+                    (
+                        portal.wxid,
+                        portal.receiver,
+                        portal.mxid,
+                        portal.name,
+                        portal.avatar_url,
+                        portal.encrypted,
+                    )
+                    for portal in portals
+                ],
+            )
+        except Exception:
+            for portal, columns in dirty:
+                portal._restore_dirty(columns)
+            raise
 
     async def delete(self) -> None:
         q = "DELETE FROM portal where wxid=$1 and receiver=$2"
@@ -93,6 +135,15 @@ class Portal:
         rows = await cls.db.fetch(q)
         return [cls._from_row(row) for row in rows]
 
+    @classmethod
+    async def all_by_receiver(cls, receiver: WechatID) -> List["Portal"]:
+        q = (
+            "SELECT wxid, receiver, mxid, name, avatar_url, encrypted "
+            "FROM portal WHERE receiver=$1"
+        )
+        rows = await cls.db.fetch(q, receiver)
+        return [cls._from_row(row) for row in rows]
+
     @classmethod
     async def all(cls) -> List["Portal"]:
         q = f"SELECT wxid, receiver, mxid, name, avatar_url, encrypted FROM portal"
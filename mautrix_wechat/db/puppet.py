@@ -1,5 +1,5 @@
 from uuid import UUID
-from typing import Optional, ClassVar, List, TYPE_CHECKING
+from typing import Optional, ClassVar, FrozenSet, List, TYPE_CHECKING
 
 from attr import dataclass
 from yarl import URL
@@ -8,12 +8,29 @@ from mautrix.types import UserID, SyncToken, ContentURI
 from mautrix.util.async_db import Database
 from wesdk.types import WechatID
 
+from mautrix_wechat.db.dirty import DirtyTracking
+
 fake_db = Database("") if TYPE_CHECKING else None
 
 
 @dataclass
-class Puppet:
+class Puppet(DirtyTracking):
     db: ClassVar[Database] = fake_db
+    _tracked_columns: ClassVar[FrozenSet[str]] = frozenset(
+        (
+            "headimg",
+            "name",
+            "remarks",
+            "wxcode",
+            "is_registered",
+            "custom_mxid",
+            "access_token",
+            "next_batch",
+            "base_url",
+            "avatar_url",
+            "profile_refreshed_at",
+        )
+    )
 
     wxid: WechatID
     headimg: str
@@ -27,54 +44,98 @@ class Puppet:
     next_batch: Optional[SyncToken]
     base_url: Optional[URL]
     avatar_url: Optional[ContentURI]
+    profile_refreshed_at: int = 0
 
     async def insert(self) -> None:
         q = (
             "INSERT INTO puppet (wxid, headimg, name, remarks, wxcode, is_registered, "
-            "                    custom_mxid, access_token, next_batch, base_url, avatar_url) "
-            "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)"
-        )
-        await self.db.execute(
-            q,
-            self.wxid,
-            self.headimg,
-            self.name,
-            self.remarks,
-            self.wxcode,
-            self.is_registered,
-            self.custom_mxid,
-            self.access_token,
-            self.next_batch,
-            self.base_url,
-            self.avatar_url
+            "                    custom_mxid, access_token, next_batch, base_url, avatar_url, "
+            "                    profile_refreshed_at) "
+            "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)"
         )
+        # Changes made while the write is in flight stay dirty
+        columns = self._take_dirty()
+        try:
+            await self.db.execute(
+                q,
+                self.wxid,
+                self.headimg,
+                self.name,
+                self.remarks,
+                self.wxcode,
+                self.is_registered,
+                self.custom_mxid,
+                self.access_token,
+                self.next_batch,
+                self.base_url,
+                self.avatar_url,
+                self.profile_refreshed_at,
+            )
+        except Exception:
+            self._restore_dirty(columns)
+            raise
 
     async def save(self) -> None:
+        columns = self._take_dirty()
+        if not columns:
+            return
+        updates = ", ".join(f"{column}=${i}" for i, column in enumerate(columns, start=2))
+        q = f"UPDATE puppet SET {updates} WHERE wxid=$1"
+        try:
+            await self.db.execute(q, self.wxid, *(getattr(self, column) for column in columns))
+        except Exception:
+            self._restore_dirty(columns)
+            raise
+
+    @classmethod
+    async def bulk_upsert(cls, puppets: List["Puppet"]) -> None:
+        if not puppets:
+            return
         q = (
-            "UPDATE puppet SET headimg=$2, name=$3, remarks=$4, wxcode=$5, is_registered=$6, "
-            "                  custom_mxid=$7, access_token=$8, next_batch=$9, base_url=$10, avatar_url=$11 "
-            "WHERE wxid=$1"
-        )
-        await self.db.execute(
-            q,
-            self.wxid,
-            self.headimg,
-            self.name,
-            self.remarks,
-            self.wxcode,
-            self.is_registered,
-            self.custom_mxid,
-            self.access_token,
-            self.next_batch,
-            self.base_url,
-            self.avatar_url
+            "INSERT INTO puppet (wxid, headimg, name, remarks, wxcode, is_registered, "
+            "                    custom_mxid, access_token, next_batch, base_url, avatar_url, "
+            "                    profile_refreshed_at) "
+            "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12) "
+            "ON CONFLICT (wxid) DO UPDATE SET "
+            "    headimg=excluded.headimg, name=excluded.name, remarks=excluded.remarks, "
+            "    wxcode=excluded.wxcode, is_registered=excluded.is_registered, "
+            "    custom_mxid=excluded.custom_mxid, access_token=excluded.access_token, "
+            "    next_batch=excluded.next_batch, base_url=excluded.base_url, "
+            "    avatar_url=excluded.avatar_url, profile_refreshed_at=excluded.profile_refreshed_at"
         )
+        dirty = [(puppet, puppet._take_dirty()) for puppet in puppets]
+        try:
+            await cls.db.executemany(
+                q,
+                [
+                    (
+                        puppet.wxid,
+                        puppet.headimg,
+                        puppet.name,
+                        puppet.remarks,
+                        puppet.wxcode,
+                        puppet.is_registered,
+                        puppet.custom_mxid,
+                        puppet.access_token,
+                        puppet.next_batch,
+                        puppet.base_url,
+                        puppet.avatar_url,
+                        puppet.profile_refreshed_at,
+                    )
+                    for puppet in puppets
+                ],
+            )
+        except Exception:
+            for puppet, columns in dirty:
+                puppet._restore_dirty(columns)
+            raise
 
     @classmethod
     async def get_by_wxid(cls, wxid: WechatID) -> Optional["Puppet"]:
         q = (
             "SELECT wxid, headimg, name, remarks, wxcode, is_registered, "
-            "       custom_mxid, access_token, next_batch, base_url, avatar_url "
+            "       custom_mxid, access_token, next_batch, base_url, avatar_url, "
+            "       profile_refreshed_at "
             "FROM puppet WHERE wxid=$1"
         )
         row = await cls.db.fetchrow(q, wxid)
@@ -86,7 +147,8 @@ class Puppet:
     async def get_by_custom_mxid(cls, mxid: UserID) -> Optional["Puppet"]:
         q = (
             "SELECT wxid, headimg, name, remarks, wxcode, is_registered, "
-            "       custom_mxid, access_token, next_batch, base_url, avatar_url "
+            "       custom_mxid, access_token, next_batch, base_url, avatar_url, "
+            "       profile_refreshed_at "
             "FROM puppet WHERE custom_mxid=$1"
         )
         row = await cls.db.fetchrow(q, mxid)
@@ -98,8 +160,20 @@ class Puppet:
     async def all_with_custom_mxid(cls) -> List["Puppet"]:
         q = (
             "SELECT wxid, headimg, name, remarks, wxcode, is_registered, "
-            "       custom_mxid, access_token, next_batch, base_url, avatar_url "
+            "       custom_mxid, access_token, next_batch, base_url, avatar_url, "
+            "       profile_refreshed_at "
             "FROM puppet WHERE custom_mxid IS NOT NULL"
         )
         rows = await cls.db.fetch(q)
         return [cls(**row) for row in rows]
+
+    @classmethod
+    async def all(cls) -> List["Puppet"]:
+        q = (
+            "SELECT wxid, headimg, name, remarks, wxcode, is_registered, "
+            "       custom_mxid, access_token, next_batch, base_url, avatar_url, "
+            "       profile_refreshed_at "
+            "FROM puppet"
+        )
+        rows = await cls.db.fetch(q)
+        return [cls(**row) for row in rows]
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+from contextlib import AsyncExitStack
+from typing import Any, Dict, List, Optional, Tuple
+
+from mautrix.util.async_db import Database
+from mautrix.util.logging import TraceLogger
+
+PendingWrite = Tuple[str, str, Tuple[Any, ...], asyncio.Future]
+
+
+async def apply_pragmas(db: Database, pragmas: Dict[str, Any], connections: int = 1) -> None:
+    """Run ``PRAGMA`` statements on every connection in the SQLite pool."""
+    async with AsyncExitStack() as stack:
+        conns = [await stack.enter_async_context(db.acquire()) for _ in range(connections)]
+        for conn in conns:
+            for name, value in pragmas.items():
+                if value is not None:
+                    await conn.execute(f"PRAGMA {name}={value}")
+
+
+class SQLiteWriteQueue:
+    """
+    Database proxy that funnels ``execute`` and ``executemany`` calls through a single writer.
+
+    Writes that are queued while the writer is busy are committed together in one short
+    transaction, with a savepoint around each statement so that a failing statement only fails
+    its own caller. Everything else is passed through to the wrapped database.
+    """
+
+    log: TraceLogger = logging.getLogger("mau.db.write_queue")
+
+    def __init__(self, db: Database, max_batch_size: int = 100) -> None:
+        self.db = db
+        self.max_batch_size = max_batch_size
+        self._pending: List[PendingWrite] = []
+        self._writer: Optional[asyncio.Task] = None
+
+    def __getattr__(self, item: str) -> Any:
+        return getattr(self.db, item)
+
+    def _enqueue(self, method: str, query: str, args: Tuple[Any, ...]) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((method, query, args, fut))
+        if not self._writer or self._writer.done():
+            self._writer = asyncio.create_task(self._write())
+        return fut
+
+    async def execute(self, query: str, *args: Any, timeout: Optional[float] = None) -> Any:
+        return await self._enqueue("execute", query, args)
+
+    async def executemany(self, query: str, *args: Any, timeout: Optional[float] = None) -> Any:
+        return await self._enqueue("executemany", query, args)
+
+    async def _write(self) -> None:
+        while self._pending:
+            batch = self._pending[: self.max_batch_size]
+            del self._pending[: self.max_batch_size]
+            try:
+                await self._write_batch(batch)
+            except Exception as e:
+                self.log.exception(f"Failed to commit batch of {len(batch)} writes")
+                for *_, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+    async def _write_batch(self, batch: List[PendingWrite]) -> None:
+        results = []
+        async with self.db.acquire() as conn, conn.transaction():
+            for method, query, args, fut in batch:
+                await conn.execute("SAVEPOINT queued_write")
+                try:
+                    result = await getattr(conn, method)(query, *args)
+                except Exception as e:
+                    await conn.execute("ROLLBACK TO SAVEPOINT queued_write")
+                    results.append((fut, None, e))
+                else:
+                    results.append((fut, result, None))
+                await conn.execute("RELEASE SAVEPOINT queued_write")
+        # Only report back once the transaction has been committed
+        for fut, result, error in results:
+            if fut.done():
+                continue
+            if error:
+                fut.set_exception(error)
+            else:
+                fut.set_result(result)
@@ -48,4 +48,44 @@ async def upgrade_v1(conn: Connection) -> None:
         FOREIGN KEY (source, receiver) REFERENCES portal(wxid, receiver)
             ON UPDATE CASCADE ON DELETE CASCADE,
         UNIQUE (mxid, mx_room)
-    )""")
\ No newline at end of file
+    )""")
+
+@upgrade_table.register(description="Add indexes for message lookups")
+async def upgrade_v2(conn: Connection) -> None:
+    # Lookups by mxid alone are already served by the UNIQUE (mxid, mx_room) index
+    await conn.execute("CREATE INDEX message_timestamp_idx ON message (timestamp)")
+    await conn.execute("CREATE INDEX message_sender_timestamp_idx ON message (sender, timestamp)")
+    await conn.execute("CREATE INDEX message_id_idx ON message (id)")
+
+
+@upgrade_table.register(description="Store when puppet profiles were last refreshed")
+async def upgrade_v3(conn: Connection) -> None:
+    await conn.execute(
+        "ALTER TABLE puppet ADD COLUMN profile_refreshed_at BIGINT NOT NULL DEFAULT 0"
+    )
+
+
+@upgrade_table.register(description="Add index for finding the last message in a room")
+async def upgrade_v4(conn: Connection) -> None:
+    await conn.execute("CREATE INDEX message_mx_room_timestamp_idx ON message (mx_room, timestamp)")
+
+
+@upgrade_table.register(description="Add journal for messages queued to be sent to WeChat")
+async def upgrade_v5(conn: Connection) -> None:
+    await conn.execute("""CREATE TABLE outbound_message (
+        event_id    TEXT PRIMARY KEY,
+        mx_room     TEXT NOT NULL,
+        box         TEXT NOT NULL,
+        sender      TEXT NOT NULL,
+        wxid        TEXT NOT NULL,
+        receiver    TEXT NOT NULL,
+        text        TEXT NOT NULL,
+        nickname    TEXT,
+        priority    INTEGER NOT NULL,
+        queued_at   BIGINT NOT NULL,
+        finished_at BIGINT
+    )""")
+    await conn.execute(
+        "CREATE INDEX outbound_message_pending_idx "
+        "ON outbound_message (box, finished_at, priority, queued_at)"
+    )
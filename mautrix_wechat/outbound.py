@@ -0,0 +1,418 @@
+import time
+import heapq
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+
+from aiohttp import ClientError
+from mautrix.types import EventID, EventType, MessageType
+from mautrix.util.logging import TraceLogger
+from mautrix.util.message_send_checkpoint import MessageSendCheckpointStatus
+from mautrix.util.opt_prometheus import Counter, Gauge, Histogram
+
+from mautrix_wechat import portal as po, user as u
+from mautrix_wechat.db import OutboundMessage as DBOutboundMessage
+from mautrix_wechat.util.rate_limit import TokenBucket
+
+if TYPE_CHECKING:
+    from .wechat import WechatHandler
+
+OUTBOUND_QUEUED = Gauge(
+    "bridge_outbound_queued", "Messages waiting to be sent to WeChat", ["box", "lane"]
+)
+OUTBOUND_BACKLOG = Gauge(
+    "bridge_outbound_backlog", "Whether a box has journaled messages not loaded yet", ["box"]
+)
+OUTBOUND_SENT = Counter(
+    "bridge_outbound_sent", "Messages sent to WeChat by outcome", ["box", "result"]
+)
+OUTBOUND_COALESCED = Counter(
+    "bridge_outbound_coalesced", "Relayed messages merged into the previous message", ["box"]
+)
+OUTBOUND_WAIT = Histogram(
+    "bridge_outbound_wait_seconds",
+    "Time messages spent queued before being sent to WeChat",
+    ["box"],
+    buckets=[0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 3600],
+)
+
+# Messages in DMs go out before the user's own group messages, which go out before relayed ones
+PRIORITY_DIRECT = 0
+PRIORITY_GROUP = 1
+PRIORITY_RELAY = 2
+LANES = {PRIORITY_DIRECT: "direct", PRIORITY_GROUP: "group", PRIORITY_RELAY: "relay"}
+
+# Errors that mean the box couldn't be reached, as opposed to the message being rejected
+RETRYABLE_ERRORS = (ClientError, asyncio.TimeoutError, OSError)
+
+# How long finished journal entries are kept to recognize events that are delivered again
+FINISHED_RETENTION = 24 * 60 * 60
+# Period over which the recent send rate of a box is measured
+SEND_RATE_PERIOD = 60
+
+
+QueuedItem = Tuple[int, int, int, "OutboundMessage"]
+
+
+class BoxUnavailable(Exception):
+    pass
+
+
+@dataclass
+class OutboundMessage:
+    portal: "po.Portal"
+    sender: "u.User"
+    event_id: EventID
+    text: str
+    nickname: Optional[str] = None
+    priority: int = PRIORITY_DIRECT
+    message_type: Optional[MessageType] = MessageType.TEXT
+    queued_at: int = field(default_factory=lambda: int(time.time() * 1000))
+
+    def checkpoint(
+        self, status: MessageSendCheckpointStatus, error: Optional[Exception] = None, retry: int = 0
+    ) -> None:
+        self.sender.send_remote_checkpoint(
+            status,
+            self.event_id,
+            self.portal.mxid,
+            EventType.ROOM_MESSAGE,
+            message_type=self.message_type,
+            error=error,
+            retry_num=retry,
+        )
+
+    def to_db(self, box: str) -> DBOutboundMessage:
+        return DBOutboundMessage(
+            event_id=self.event_id,
+            mx_room=self.portal.mxid,
+            box=box,
+            sender=self.sender.mxid,
+            wxid=self.portal.wxid,
+            receiver=self.portal.receiver,
+            text=self.text,
+            nickname=self.nickname,
+            priority=self.priority,
+            queued_at=self.queued_at,
+        )
+
+
+class OutboundQueue:
+    """
+    Durable, paced queue for the messages one box sends to WeChat.
+
+    Every message is written to the ``outbound_message`` journal before it's queued, so queued
+    messages survive box disconnects and bridge restarts, and an event that is delivered to the
+    bridge again isn't sent twice. Only up to ``batch_size`` messages are held in memory; when
+    more are waiting, the rest stay in the journal and are loaded a batch at a time, so a large
+    backlog drains without holding up the other boxes. Messages with a higher priority than
+    anything left in the journal skip it, so e.g. DMs don't wait behind a relay backlog.
+
+    Sends are limited by a token bucket, so that a burst of Matrix messages doesn't get the
+    account throttled, and go out by priority lane and then in the order they were queued.
+    Relayed messages for the same portal that are queued within ``coalesce_window`` seconds of
+    each other can be merged into one multi-line WeChat message.
+    Sends that fail because the box couldn't be reached are retried with exponential backoff.
+    If the box has disconnected by then, the queue waits for it to come back instead of failing
+    the message. Settings come from ``wechat.outbound`` and can be overridden per box.
+    """
+
+    log: TraceLogger = logging.getLogger("mau.outbound")
+
+    _queue: List[QueuedItem]
+    _queued: Set[EventID]
+    _pending: Dict[EventID, "po.Portal"]
+    _sent_at: Deque[float]
+    _task: Optional[asyncio.Task]
+    _wakeup: asyncio.Event
+    _connected: asyncio.Event
+
+    def __init__(self, handler: "WechatHandler", overrides: Optional[Dict[str, Any]] = None):
+        self.handler = handler
+        self.config = handler.config
+        self.overrides = dict(overrides or {})
+        self.log = self.log.getChild(handler.box)
+        self.bucket = TokenBucket(self._setting("rate"), self._setting("burst"))
+        self.config.add_reload_listener(self._on_config_reload)
+        self._queue = []
+        self._queued = set()
+        # Portals of the messages that aren't finished yet, including ones only in the journal
+        self._pending = {}
+        self._counter = 0
+        self._sent_at = deque()
+        # Start by loading whatever was left in the journal
+        self._backlog = True
+        # Highest priority of the messages that may still be in the journal but not in memory
+        self._backlog_priority = PRIORITY_DIRECT
+        self._journal_lock = asyncio.Lock()
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._connected = asyncio.Event()
+        for priority, lane in LANES.items():
+            OUTBOUND_QUEUED.labels(box=handler.box, lane=lane).set_function(
+                lambda priority=priority: self.depth(priority)
+            )
+        OUTBOUND_BACKLOG.labels(box=handler.box).set_function(lambda: int(self._backlog))
+
+    def _setting(self, key: str) -> Any:
+        try:
+            return self.overrides[key]
+        except KeyError:
+            return getattr(self.config.snapshot.wechat.outbound, key)
+
+    def _on_config_reload(self, _: Any) -> None:
+        # The other settings are read from the snapshot whenever they're used
+        self.bucket.rate = self._setting("rate")
+        self.bucket.burst = max(1, self._setting("burst"))
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def depth(self, priority: Optional[int] = None) -> int:
+        if priority is None:
+            return len(self._queue)
+        return sum(1 for item in self._queue if item[0] == priority)
+
+    @property
+    def load(self) -> int:
+        """Number of queued messages, counting a journal backlog as at least a full batch."""
+        if self._backlog:
+            return max(len(self._queue), self._setting("batch_size"))
+        return len(self._queue)
+
+    @property
+    def send_rate(self) -> float:
+        """Messages sent per second over the last minute."""
+        cutoff = time.monotonic() - SEND_RATE_PERIOD
+        while self._sent_at and self._sent_at[0] < cutoff:
+            self._sent_at.popleft()
+        return len(self._sent_at) / SEND_RATE_PERIOD
+
+    def _push(self, msg: OutboundMessage) -> None:
+        self._counter += 1
+        self._queued.add(msg.event_id)
+        heapq.heappush(self._queue, (msg.priority, msg.queued_at, self._counter, msg))
+
+    def _hold(self, msg: OutboundMessage) -> None:
+        # Keeps the portal from being evicted, so that a restored message gets the same instance
+        if msg.event_id not in self._pending:
+            self._pending[msg.event_id] = msg.portal
+            msg.portal.outbound_pending += 1
+
+    def _release(self, event_id: EventID) -> None:
+        portal = self._pending.pop(event_id, None)
+        if portal:
+            portal.outbound_pending -= 1
+
+    def _ensure_running(self) -> None:
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    async def send(self, msg: OutboundMessage) -> bool:
+        """
+        Journal and queue a message. The result is reported to the portal once it's sent.
+
+        :returns: ``False`` if the event was already queued before and was ignored.
+        """
+        async with self._journal_lock:
+            if not await msg.to_db(self.handler.box).insert():
+                return False
+            self._hold(msg)
+            if self._backlog and msg.priority < self._backlog_priority:
+                # Nothing in the journal has to go out first
+                self._push(msg)
+            elif self._backlog or len(self._queue) >= self._setting("batch_size"):
+                # Leave it in the journal, it'll be loaded in order with the rest of the backlog
+                if not self._backlog or msg.priority < self._backlog_priority:
+                    self._backlog_priority = msg.priority
+                self._backlog = True
+            else:
+                self._push(msg)
+        self._ensure_running()
+        return True
+
+    def on_connect(self) -> None:
+        self._connected.set()
+        self._ensure_running()
+
+    def on_disconnect(self) -> None:
+        self._connected.clear()
+
+    def stop(self) -> None:
+        # Messages that weren't sent yet stay in the journal and keep their portals
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self._queue = []
+        self._queued = set()
+        self._backlog = True
+        self._backlog_priority = PRIORITY_DIRECT
+
+    async def _load_batch(self) -> None:
+        batch_size = self._setting("batch_size")
+        async with self._journal_lock:
+            await DBOutboundMessage.prune(int((time.time() - FINISHED_RETENTION) * 1000))
+            entries = await DBOutboundMessage.get_pending(self.handler.box, batch_size)
+            for entry in entries:
+                if entry.event_id in self._queued:
+                    continue
+                msg = await self._restore(entry)
+                if msg:
+                    self._hold(msg)
+                    self._push(msg)
+                else:
+                    self.log.warning("Dropping %s, its portal or sender is gone", entry.event_id)
+                    self._release(entry.event_id)
+                    await DBOutboundMessage.mark_finished(entry.event_id, int(time.time() * 1000))
+            self._backlog = len(entries) >= batch_size
+            if self._backlog:
+                # Entries are loaded by priority, so the rest can't have a higher one
+                self._backlog_priority = entries[-1].priority
+        if entries:
+            self.log.debug("Loaded %d queued messages from the journal", len(entries))
+
+    @staticmethod
+    async def _restore(entry: DBOutboundMessage) -> Optional[OutboundMessage]:
+        portal = await po.Portal.get_by_wxid(entry.wxid, entry.receiver)
+        sender = await u.User.get_by_mxid(entry.sender, create=False)
+        if not portal or not portal.mxid or not sender:
+            return None
+        return OutboundMessage(
+            portal,
+            sender,
+            entry.event_id,
+            entry.text,
+            entry.nickname,
+            entry.priority,
+            queued_at=entry.queued_at,
+        )
+
+    async def _run(self) -> None:
+        while True:
+            if not self._queue:
+                if self._backlog:
+                    await self._load_batch()
+                    if self._queue:
+                        continue
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if not self.handler.connected:
+                self._connected.clear()
+                await self._connected.wait()
+                continue
+            await self.bucket.acquire()
+            items = await self._take()
+            try:
+                result = await self._deliver([item[3] for item in items])
+            except asyncio.CancelledError:
+                raise
+            except BoxUnavailable as e:
+                # Keep the messages at the front of their lane until the box is back
+                for item in items:
+                    heapq.heappush(self._queue, item)
+                    item[3].checkpoint(MessageSendCheckpointStatus.WILL_RETRY, e)
+                self.log.warning("Box is unavailable, waiting for it to reconnect")
+                continue
+            except Exception as e:
+                OUTBOUND_SENT.labels(box=self.handler.box, result="failure").inc(len(items))
+                for item in items:
+                    await self._finish(item[3], e)
+            else:
+                OUTBOUND_SENT.labels(box=self.handler.box, result="success").inc(len(items))
+                OUTBOUND_COALESCED.labels(box=self.handler.box).inc(len(items) - 1)
+                self._sent_at.append(time.monotonic())
+                now = time.time()
+                for item in items:
+                    OUTBOUND_WAIT.labels(box=self.handler.box).observe(
+                        max(0.0, now - item[3].queued_at / 1000)
+                    )
+                self.log.trace("Sent %s: %s", ", ".join(i[3].event_id for i in items), result)
+                for item in items:
+                    await self._finish(item[3], None)
+
+    async def _take(self) -> List[QueuedItem]:
+        item = heapq.heappop(self._queue)
+        msg = item[3]
+        window = self._setting("coalesce_window")
+        if window <= 0 or msg.priority != PRIORITY_RELAY or msg.nickname:
+            return [item]
+        # Give the chat until the end of the window to add more messages
+        delay = msg.queued_at / 1000 + window - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        items = [item]
+        length = len(msg.text)
+        max_messages = self._setting("coalesce_max_messages")
+        max_length = self._setting("coalesce_max_length")
+        for other_item in sorted(self._queue):
+            other = other_item[3]
+            if other.priority != PRIORITY_RELAY or other.portal.wxid != msg.portal.wxid:
+                continue
+            length += 1 + len(other.text)
+            # Messages to the chat must stay in order, so stop at the first one that can't merge.
+            # Other portals of the chat can't, the echo is only expected for this one's box.
+            if (
+                other.portal.receiver != msg.portal.receiver
+                or other.nickname
+                or len(items) >= max_messages
+                or length > max_length
+            ):
+                break
+            items.append(other_item)
+        if len(items) > 1:
+            taken = {other_item[2] for other_item in items}
+            self._queue = [other_item for other_item in self._queue if other_item[2] not in taken]
+            heapq.heapify(self._queue)
+        return items
+
+    async def _finish(self, msg: OutboundMessage, err: Optional[Exception]) -> None:
+        self._queued.discard(msg.event_id)
+        try:
+            await DBOutboundMessage.mark_finished(msg.event_id, int(time.time() * 1000))
+        except Exception:
+            self.log.exception("Failed to mark %s as sent in the journal", msg.event_id)
+        try:
+            await msg.portal.handle_outbound_result(msg, err)
+        except Exception:
+            self.log.exception("Failed to report result of sending %s", msg.event_id)
+        finally:
+            self._release(msg.event_id)
+
+    async def _deliver(self, msgs: List[OutboundMessage]) -> Any:
+        msg = msgs[0]
+        text = "\n".join(queued.text for queued in msgs)
+        if msg.portal.receiver != self.handler.wx_id:
+            # Sent for another box's portal, which will receive it back from this account
+            msg.portal.bridge.relay_router.expect_echo(
+                msg.portal.wxid, msg.portal.receiver, self.handler.wx_id, text
+            )
+        max_retries = self._setting("max_retries")
+        retry_delay = self._setting("retry_delay")
+        attempt = 0
+        while True:
+            try:
+                return await self.handler.send_msg(
+                    text, msg.portal.wxid, msg.portal.wxid, nickname=msg.nickname or "null"
+                )
+            except RETRYABLE_ERRORS as e:
+                if not self.handler.connected:
+                    raise BoxUnavailable(f"Box {self.handler.box} is disconnected") from e
+                if attempt >= max_retries:
+                    raise
+                attempt += 1
+                OUTBOUND_SENT.labels(box=self.handler.box, result="retry").inc()
+                self.log.warning(
+                    "Failed to send %s (attempt %d/%d), retrying: %s",
+                    msg.event_id,
+                    attempt,
+                    max_retries + 1,
+                    e,
+                )
+                msg.checkpoint(MessageSendCheckpointStatus.WILL_RETRY, e, retry=attempt)
+                # Later messages wait too, so that messages to a chat stay in order
+                await asyncio.sleep(retry_delay * 2 ** (attempt - 1))
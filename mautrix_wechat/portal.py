@@ -1,5 +1,6 @@
+import copy
 import asyncio
-from collections import deque
+import functools
 from datetime import datetime
 from typing import (
     TYPE_CHECKING,
@@ -8,11 +9,12 @@ from typing import (
     AsyncIterable,
     Awaitable,
     Dict,
+    List,
     Optional,
+    Set,
     Tuple,
     Union,
     cast,
-    Deque
 )
 from uuid import UUID
 from venv import create
@@ -21,9 +23,11 @@ from lxml import etree
 from mautrix.appservice import AppService, IntentAPI
 
 # from mausignald.types import Address, Contact, Profile
-from mautrix.bridge import BasePortal, async_getter_lock, puppet
+from mautrix.bridge import BasePortal, puppet
 from mautrix.errors import MatrixError
 from mautrix.types import (
+    BatchSendEvent,
+    BatchSendStateEvent,
     BeeperMessageStatusEventContent,
     ContentURI,
     EncryptionAlgorithm,
@@ -32,6 +36,7 @@ from mautrix.types import (
     ImageInfo,
     MediaMessageEventContent,
     Membership,
+    MemberStateEventContent,
     MessageEventContent,
     MessageStatusReason,
     MessageType,
@@ -43,6 +48,7 @@ from mautrix.types import (
     UserID,
 )
 from mautrix.util.message_send_checkpoint import MessageSendCheckpointStatus
+from mautrix.util.opt_prometheus import Counter, Histogram, async_time
 from mautrix.util.simple_template import SimpleTemplate
 from wesdk.types import Message as WechatMessage, PicMessage, TxtMessage, TxtCiteMessage
 from wesdk.types import WechatID, WechatUser
@@ -55,8 +61,22 @@ from mautrix_wechat import wechat as w
 from mautrix_wechat.config import Config
 from mautrix_wechat.db import Message as DBMessage
 from mautrix_wechat.db import Portal as DBPortal
-from mautrix_wechat.util.locks import PortalSendLock
+from mautrix_wechat.outbound import (
+    PRIORITY_DIRECT,
+    PRIORITY_GROUP,
+    PRIORITY_RELAY,
+    OutboundMessage,
+)
+from mautrix_wechat.util.locks import PortalSendLock, StripedLock
 from mautrix_wechat.util.containers import SizedDict
+from mautrix_wechat.util.dedup import (
+    DedupWindow,
+    MessageClaim,
+    RecentMessageIndex,
+    content_hash,
+)
+from mautrix_wechat.util.eviction import IdleTracking, in_flight, select_evictable
+from mautrix_wechat.util.pipeline import OrderedPipeline
 
 if TYPE_CHECKING:
     from .__main__ import WechatBridge
@@ -64,6 +84,31 @@ if TYPE_CHECKING:
 StateBridge = EventType.find("m.bridge", EventType.Class.STATE)
 StateHalfShotBridge = EventType.find("uk.half-shot.bridge", EventType.Class.STATE)
 
+# Boxes deliver the messages they queued while we were away in a burst, wait for all of it
+BACKFILL_COLLECT_DELAY = 5
+# How long to wait for another box to format a message before formatting it again. Later
+# messages to the room wait too, so this is kept short.
+CROSS_BOX_WAIT_TIMEOUT = 2
+
+MESSAGE_STAGE_TIME = Histogram(
+    "bridge_message_stage_seconds",
+    "Time spent in each stage of bridging a message from WeChat",
+    ["stage"],
+)
+DEDUP_HITS = Counter(
+    "bridge_message_dedup_hits", "Messages from WeChat dropped as duplicates", ["source"]
+)
+CROSS_BOX_DUPLICATES = Counter(
+    "bridge_cross_box_duplicates",
+    "Group messages that another box already received",
+    ["action"],
+)
+PIPELINE_DEPTH = Histogram(
+    "bridge_portal_pipeline_depth",
+    "Number of messages queued in a portal's send pipeline when a message is added",
+    buckets=[1, 2, 4, 8, 16, 32, 64, 128, 256],
+)
+
 
 class BridgingError(Exception):
     pass
@@ -73,21 +118,37 @@ class IgnoredMessageError(Exception):
     pass
 
 
-class Portal(DBPortal, BasePortal):
+MissedMessage = Tuple["u.User", "p.Puppet", WechatMessage, Optional[WechatUser], bool]
+ConvertedMessage = Tuple["u.User", "p.Puppet", WechatMessage, MessageEventContent]
+
+
+class Portal(DBPortal, BasePortal, IdleTracking):
     by_mxid: Dict[RoomID, "Portal"] = {}
     by_wxid: Dict[Tuple[WechatID, WechatID], "Portal"] = {}
+    # Relay users aren't stored in the database, so keep them around for evicted portals
+    _evicted_relay_users: Dict[Tuple[WechatID, WechatID], UserID] = {}
+    # The event loop only keeps weak references to tasks, so keep the ones nothing awaits here
+    _background_tasks: Set[asyncio.Task] = set()
+    _getter_lock: StripedLock = StripedLock()
     config: Config
     matrix: "m.MatrixHandler"
     wechat: "w.WechatHandler"
     az: AppService
     private_chat_portal_meta: bool
     deleted: bool
+    # Messages queued or journaled by the outbound queues, which hold on to this instance
+    outbound_pending: int
 
     _main_intent: Optional[IntentAPI]
     _create_room_lock: asyncio.Lock
     _send_lock: PortalSendLock
-    _msg_dedup: Deque[Tuple[str, WechatID, WechatID, datetime]]
+    recent_messages: Optional[RecentMessageIndex] = None
+
+    _msg_dedup: DedupWindow
     _msg_cache: Dict[Tuple[WechatID, WechatID, str], EventID]
+    _pipeline: OrderedPipeline
+    _missed_messages: List[MissedMessage]
+    _backfill_task: Optional[asyncio.Task]
 
     @classmethod
     def init_cls(cls, bridge: "WechatBridge") -> None:
@@ -96,6 +157,10 @@ class Portal(DBPortal, BasePortal):
         cls.az = bridge.az
         cls.loop = bridge.loop
         BasePortal.bridge = bridge
+        cross_box = cls.config.snapshot.bridge.cross_box_dedup
+        # Only group chats that several boxes are members of can be received twice
+        if cross_box.enabled and len(cls.config.snapshot.wechat.boxes) > 1:
+            cls.recent_messages = RecentMessageIndex(cross_box.max_entries, cross_box.ttl)
 
     def __init__(
         self,
@@ -116,21 +181,26 @@ class Portal(DBPortal, BasePortal):
         )
         BasePortal.__init__(self)
         self.deleted = False
+        self.outbound_pending = 0
         self.log = self.log.getChild(self.wxid)
         self._main_intent = None
         self.relay_user_id = None
         self._relay_user = None
         self._create_room_lock = asyncio.Lock()
         self._send_lock = PortalSendLock()
-        self._msg_dedup = deque(maxlen=100)
+        self._msg_dedup = DedupWindow(
+            maxlen=self.config.snapshot.bridge.message_dedup.window_size,
+            bloom_capacity=self.config.snapshot.bridge.message_dedup.bloom_filter_capacity,
+            bloom_error_rate=self.config.snapshot.bridge.message_dedup.bloom_filter_error_rate,
+        )
         self._msg_cache = SizedDict(maxlen=100)
+        self._pipeline = OrderedPipeline(
+            self.config.snapshot.bridge.message_pipeline.max_concurrent
+        )
+        self._missed_messages = []
+        self._backfill_task = None
 
-    async def _postinit(self) -> None:
-        if self.wxid:
-            self.by_wxid[(self.wxid, self.receiver)] = self
-        if self.mxid:
-            self.by_mxid[self.mxid] = self
-
+    async def _postinit(self) -> "Portal":
         if self.is_direct:
             puppet = await p.Puppet.get_by_wxid(self.wxid, create=True)
             puppet: p.Puppet
@@ -138,6 +208,21 @@ class Portal(DBPortal, BasePortal):
         else:
             self._main_intent = self.az.intent
 
+        # Only register once fully initialized, as cache hits don't wait for any lock. If another
+        # lookup loaded the same portal in the meantime, that instance wins.
+        portal = self.by_wxid.setdefault((self.wxid, self.receiver), self)
+        if portal is self:
+            relay_user_id = self._evicted_relay_users.pop((self.wxid, self.receiver), None)
+            self.relay_user_id = self.relay_user_id or relay_user_id
+        if portal.mxid:
+            self.by_mxid.setdefault(portal.mxid, portal)
+        portal.touch()
+        return portal
+
+    @property
+    def pipeline_depth(self) -> int:
+        return len(self._pipeline)
+
     @property
     def is_direct(self) -> bool:
         return not self.wxid.endswith("chatroom")
@@ -162,7 +247,7 @@ class Portal(DBPortal, BasePortal):
             "protocol": {
                 "id": "wechat",
                 "displayname": "Wechat",
-                "avatar_url": self.config["appservice.bot_avatar"],
+                "avatar_url": self.config.snapshot.appservice.bot_avatar,
             },
             "channel": {
                 "id": self.mxid,
@@ -173,49 +258,100 @@ class Portal(DBPortal, BasePortal):
         return info
 
     @classmethod
-    @async_getter_lock
     async def get_by_wxid(
         cls, wxid: WechatID, receiver: Optional[WechatID], create: bool = False
     ) -> Optional["Portal"]:
-        if (wxid, receiver) in cls.by_wxid:
-            return cls.by_wxid[(wxid, receiver)]
-
-        portal = cast(cls, await super().get_by_wxid(wxid, receiver))
-        if portal:
-            await portal._postinit()
-        elif create:
-            portal = cls(wxid, receiver)
-            await portal.insert()
-            await portal._postinit()
-        return portal
+        try:
+            portal = cls.by_wxid[(wxid, receiver)]
+            portal.touch()
+            return portal
+        except KeyError:
+            pass
+
+        async with cls._getter_lock((wxid, receiver)):
+            try:
+                return cls.by_wxid[(wxid, receiver)]
+            except KeyError:
+                pass
+
+            portal = cast(cls, await super().get_by_wxid(wxid, receiver))
+            if portal:
+                return await portal._postinit()
+            elif create:
+                portal = cls(wxid, receiver)
+                await portal.insert()
+                return await portal._postinit()
+            return None
 
     @classmethod
-    @async_getter_lock
     async def get_by_mxid(cls, mxid: RoomID) -> Optional["Portal"]:
         try:
-            return cls.by_mxid[mxid]
+            portal = cls.by_mxid[mxid]
+            portal.touch()
+            return portal
         except KeyError:
             pass
 
-        portal = cast(cls, await super().get_by_mxid(mxid))
-        if portal:
-            await portal._postinit()
-            return portal
+        async with cls._getter_lock(mxid):
+            try:
+                return cls.by_mxid[mxid]
+            except KeyError:
+                pass
+
+            portal = cast(cls, await super().get_by_mxid(mxid))
+            if portal:
+                return await portal._postinit()
+            return None
 
-        return None
+    @classmethod
+    async def get_all_by_receiver(cls, receiver: WechatID) -> Dict[WechatID, "Portal"]:
+        portals = {}
+        portal: "Portal"
+        for portal in await super().all_by_receiver(receiver):
+            try:
+                portal = cls.by_wxid[(portal.wxid, portal.receiver)]
+            except KeyError:
+                portal = await portal._postinit()
+            portals[portal.wxid] = portal
+        return portals
 
-    async def delete(self) -> None:
-        try:
+    async def set_relay_user(self, user: Optional["u.User"]) -> None:
+        # The relay user isn't stored in the portal table, so unlike BasePortal don't save here
+        if not self.config.snapshot.bridge.relay.enabled:
+            raise RuntimeError("Can't set_relay_user() when relay mode is not enabled")
+        self._relay_user = user
+        self.relay_user_id = user.mxid if user else None
+
+    @property
+    def is_busy(self) -> bool:
+        return (
+            super().is_busy
+            or self.is_dirty
+            or self.outbound_pending > 0
+            or self._create_room_lock.locked()
+            or self._send_lock.locked
+            or bool(self._missed_messages)
+            or bool(self._backfill_task and not self._backfill_task.done())
+        )
+
+    def _uncache(self) -> None:
+        if self.by_wxid.get((self.wxid, self.receiver)) is self:
             del self.by_wxid[(self.wxid, self.receiver)]
-        except KeyError:
-            pass
+        if self.mxid and self.by_mxid.get(self.mxid) is self:
+            del self.by_mxid[self.mxid]
 
-        try:
-            if self.mxid:
-                del self.by_mxid[self.mxid]
-        except KeyError:
-            pass
+    @classmethod
+    def evict_idle(cls, max_idle: float, max_size: int = 0, min_idle: float = 60) -> int:
+        portals = select_evictable(list(cls.by_wxid.values()), max_idle, max_size, min_idle)
+        for portal in portals:
+            portal._uncache()
+            if portal.relay_user_id:
+                cls._evicted_relay_users[(portal.wxid, portal.receiver)] = portal.relay_user_id
+        return len(portals)
 
+    async def delete(self) -> None:
+        self._uncache()
+        self._evicted_relay_users.pop((self.wxid, self.receiver), None)
         await super().delete()
         if self.mxid:
             await DBMessage.delete_all(self.mxid)
@@ -232,7 +368,7 @@ class Portal(DBPortal, BasePortal):
             self._msg_cache[(msg.sender, msg.source, msg.content)] = event_id
 
     async def _send_delivery_receipt(self, event_id: EventID) -> None:
-        if self.config["bridge.delivery_receipts"]:
+        if self.config.snapshot.bridge.delivery_receipts:
             try:
                 await self.az.intent.mark_read(self.mxid, event_id)
             except Exception:
@@ -241,7 +377,7 @@ class Portal(DBPortal, BasePortal):
     async def _send_message_status(
         self, event_id: EventID, err: Optional[Exception]
     ) -> None:
-        if not self.config["bridge.message_status_events"]:
+        if not self.config.snapshot.bridge.message_status_events:
             return
         intent = self.az.intent if self.encrypted else self.main_intent
         status = BeeperMessageStatusEventContent(
@@ -282,7 +418,7 @@ class Portal(DBPortal, BasePortal):
             error=err,
         )
 
-        if self.config["bridge.delivery_error_reports"]:
+        if self.config.snapshot.bridge.delivery_error_reports:
             msg = TextMessageEventContent(
                 msgtype=MessageType.NOTICE, body=msg or str(err)
             )
@@ -290,6 +426,29 @@ class Portal(DBPortal, BasePortal):
             await self._send_message(self.main_intent, msg)
         await self._send_message_status(event_id, err)
 
+    async def _get_relay_client(self) -> Optional["w.WechatHandler"]:
+        relay_user = await self.get_relay_user()
+        client = relay_user.client if relay_user and relay_user.client.can_relay else None
+        if self.is_direct:
+            # Only the account the DM belongs to can send to it
+            return client
+        # Any relay box that is in the group can send to it
+        return self.bridge.relay_router.route(self.wxid, client)
+
+    async def handle_outbound_result(
+        self, msg: OutboundMessage, err: Optional[Exception]
+    ) -> None:
+        if err:
+            self.log.error("Failed to send %s: %s", msg.event_id, err)
+            await self._send_bridge_error(
+                msg.sender, err, msg.event_id, EventType.ROOM_MESSAGE, msg.message_type
+            )
+            return
+        msg.checkpoint(MessageSendCheckpointStatus.SUCCESS)
+        await self._send_delivery_receipt(msg.event_id)
+        await self._send_message_status(msg.event_id, None)
+
+    @in_flight
     async def handle_matrix_message(
         self, sender: u.User, content: MessageEventContent, event_id: EventID
     ) -> None:
@@ -300,19 +459,22 @@ class Portal(DBPortal, BasePortal):
                 raise IgnoredMessageError("Message doesn't have a body")
 
             if content.msgtype in (MessageType.TEXT,):
+                # Format and queue under the lock so that the sender's messages keep their order
                 async with self._send_lock(sender.wxid):
                     if self.receiver == sender.wxid:
                         msg, nick = await fmt.matrix_to_wechat(content, sender)
-                        data = await sender.client.send_msg(msg, self.wxid, self.wxid, nickname=nick or "null")
-                        self.log.debug(data)
-                    # TODO: maybe user get_relay_sender
-                    elif relay_user := await self.get_relay_user():
-                        if relay_user.client.can_relay:
-                            msg, nick = await fmt.matrix_to_wechat(content, sender, relay_user.client.show_sender)
-                            data = await relay_user.client.send_msg(msg, self.wxid, self.wxid, nickname=nick or "null")
-                            self.log.debug(data)
+                        client = sender.client
+                        priority = PRIORITY_DIRECT if self.is_direct else PRIORITY_GROUP
+                    elif client := await self._get_relay_client():
+                        msg, nick = await fmt.matrix_to_wechat(content, sender, client.show_sender)
+                        priority = PRIORITY_RELAY
                     else:
                         raise IgnoredMessageError(f"Relaying message not supported!")
+                    queued = await client.outbound.send(
+                        OutboundMessage(self, sender, event_id, msg, nick, priority)
+                    )
+                if not queued:
+                    self.log.debug("Ignoring %s as it was already queued before", event_id)
                 # await self._handle_matrix_text(sender, content, event_id)
             else:
                 raise IgnoredMessageError(
@@ -328,6 +490,7 @@ class Portal(DBPortal, BasePortal):
                 message_type=content.msgtype,
             )
 
+    @in_flight
     async def handle_message(
         self,
         user: u.User,
@@ -335,37 +498,151 @@ class Portal(DBPortal, BasePortal):
         msg: WechatMessage,
         info: Optional[WechatUser] = None,
     ) -> None:
-        if not self.mxid:
-            await self.create_matrix_room(user, info)
-            if not self.mxid:
-                self.log.warning(
-                    f"Failed to create room for incoming message ({msg.time}): {msg.content}"
-                )
-                return
-        if (msg.id, msg.source, msg.sender, msg.time) in self._msg_dedup:
+        dedup_key = (msg.id, msg.source, msg.sender, msg.time)
+        if dedup_key in self._msg_dedup:
+            DEDUP_HITS.labels(source="memory").inc()
             self.log.debug(
-                f"Ignoring message by {msg.sender} in {msg.source} at {msg.time} as it was already handled: {msg}"
+                "Ignoring message %s by %s at %s as it was already handled",
+                msg.id,
+                msg.sender,
+                msg.time,
+                extra={"sample": "dedup"},
             )
             return
-        self._msg_dedup.appendleft((msg.id, msg.source, msg.sender, msg.time))
-
-        if await DBMessage.get_by_wechat_id(
-            msg.sender, msg.source, self.wxid, msg.time.timestamp()
+        # Only go to the database when the in-memory window can't rule out a duplicate
+        # Message times are in the box's local time, so the age is measured on its clock
+        box_time = user.client.box_time() if user.client else None
+        age = (box_time - msg.time).total_seconds() if box_time else None
+        probably_handled = self._msg_dedup.maybe_seen(dedup_key, age)
+        self._msg_dedup.add(dedup_key)
+
+        if (
+            not self.is_direct
+            and isinstance(content := getattr(msg, "content", None), str)
+            and self.bridge.relay_router.is_echo(msg.source, self.receiver, msg.sender, content)
         ):
             self.log.debug(
-                f"Ignoring message by {msg.sender} in {msg.source} at {msg.time} as it was already handled: {msg}"
+                "Ignoring message %s by %s as it was relayed from this room through another box",
+                msg.id,
+                msg.sender,
+                extra={"sample": "dedup"},
             )
             return
-        self.log.debug(
-            f"Start handling message {msg.id} by {msg.sender} in {msg.source} at {msg.time}"
+
+        if self._is_missed(user, msg):
+            self._missed_messages.append((user, sender, msg, info, probably_handled))
+            if not self._backfill_task or self._backfill_task.done():
+                self._backfill_task = asyncio.create_task(self._backfill_missed())
+            return
+
+        claim = first = None
+        if self.recent_messages and not self.is_direct:
+            claim, first = self.recent_messages.claim(
+                (msg.source, msg.sender, msg.time, content_hash(getattr(msg, "content", "")))
+            )
+            box = user.client.box if user.client else None
+            bridged_by = claim.rooms.get(self.mxid) if self.mxid else None
+            if not first and bridged_by is None:
+                CROSS_BOX_DUPLICATES.labels(action="reused").inc()
+            elif not first and bridged_by == box:
+                # The box got the same text from the same sender twice within a second, so it's
+                # a separate message rather than another box's copy
+                claim = None
+                first = True
+            elif not first:
+                CROSS_BOX_DUPLICATES.labels(action="dropped").inc()
+                self.log.debug(
+                    "Ignoring message %s by %s as another box already bridged it",
+                    msg.id,
+                    msg.sender,
+                    extra={"sample": "dedup"},
+                )
+                return
+            if claim and self.mxid:
+                claim.rooms.setdefault(self.mxid, box)
+
+        # Queue the message before awaiting anything, so messages are sent in the order they came
+        # in, while formatting and media uploads of consecutive messages overlap
+        result = self._pipeline.submit(
+            self._prepare_message(user, msg, info, probably_handled, claim, first),
+            functools.partial(self._deliver_message, sender, msg),
+            functools.partial(self._persist_message, user, msg),
         )
-        self.log.trace(f"Message: {msg}")
+        PIPELINE_DEPTH.observe(len(self._pipeline))
+        try:
+            await result
+        except IgnoredMessageError as e:
+            self.log.debug("%s", e, extra={"sample": "ignored"})
 
-        intent = sender.intent_for(self)
-        content = await fmt.wechat_to_matrix(msg, self, self._msg_cache)
-        event_id = await self._send_message(intent, content, timestamp=msg.time)
-        if len(getattr(msg, 'content', '')):
+    @async_time(MESSAGE_STAGE_TIME.labels(stage="prepare"))
+    async def _prepare_message(
+        self,
+        user: u.User,
+        msg: WechatMessage,
+        info: Optional[WechatUser],
+        probably_handled: bool,
+        claim: Optional[MessageClaim] = None,
+        first: bool = True,
+    ) -> Optional[MessageEventContent]:
+        try:
+            if not self.mxid:
+                await self.create_matrix_room(user, info)
+                if not self.mxid:
+                    self.log.warning(
+                        f"Failed to create room for incoming message ({msg.time}): {msg.content}"
+                    )
+                    raise IgnoredMessageError("No room to send the message to")
+            if probably_handled and await self._is_handled(msg):
+                DEDUP_HITS.labels(source="database").inc()
+                raise IgnoredMessageError(
+                    f"Ignoring message {msg.id} by {msg.sender} at {msg.time} "
+                    "as it was already handled"
+                )
+            self.log.debug(
+                "Start handling message %s by %s at %s",
+                msg.id,
+                msg.sender,
+                msg.time,
+                extra={"sample": "message"},
+            )
+            self.log.trace("Message: %s", msg)
+            if isinstance(msg, TxtCiteMessage):
+                # The quoted message may still be in the pipeline, so format this one when it's
+                # sent. Quotes point to events in this room, so the content can't be shared either
+                return None
+            if claim is not None and not first:
+                # Another box received the same group message, reuse its formatted content and
+                # uploaded media
+                try:
+                    content = await asyncio.wait_for(
+                        asyncio.shield(claim.result), CROSS_BOX_WAIT_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    content = None
+                if content is not None:
+                    return copy.deepcopy(content)
+            content = await fmt.wechat_to_matrix(msg, self, self._msg_cache)
+            if claim is not None:
+                claim.resolve(content)
+            return content
+        finally:
+            if claim is not None and first:
+                # Don't leave the other boxes waiting if this one didn't get to format it
+                claim.resolve(None)
+
+    @async_time(MESSAGE_STAGE_TIME.labels(stage="deliver"))
+    async def _deliver_message(
+        self, sender: p.Puppet, msg: WechatMessage, content: Optional[MessageEventContent]
+    ) -> EventID:
+        if content is None:
+            content = await fmt.wechat_to_matrix(msg, self, self._msg_cache)
+        event_id = await self._send_message(sender.intent_for(self), content, timestamp=msg.time)
+        if len(getattr(msg, "content", "")):
             self._set_msg_cache(msg, event_id)
+        return event_id
+
+    @async_time(MESSAGE_STAGE_TIME.labels(stage="persist"))
+    async def _persist_message(self, user: u.User, msg: WechatMessage, event_id: EventID) -> None:
         await DBMessage(
             event_id,
             self.mxid,
@@ -373,8 +650,155 @@ class Portal(DBPortal, BasePortal):
             msg.sender,
             msg.source,
             user.wxid,
-            datetime.timestamp(msg.time),
-        ).insert()
+            int(datetime.timestamp(msg.time)),
+        ).insert_batched()
+
+    @async_time(MESSAGE_STAGE_TIME.labels(stage="dedup_lookup"))
+    async def _is_handled(self, msg: WechatMessage) -> bool:
+        return bool(
+            await DBMessage.get_by_wechat_id(
+                msg.sender, msg.source, self.receiver, int(msg.time.timestamp())
+            )
+        )
+
+    def _is_missed(self, user: u.User, msg: WechatMessage) -> bool:
+        max_age = self.config.snapshot.bridge.backfill.missed_message_age
+        if max_age <= 0 or not user.client:
+            return False
+        # Message times are in the box's local time, so they're compared against its clock
+        box_time = user.client.box_time()
+        return box_time is not None and (box_time - msg.time).total_seconds() > max_age
+
+    async def _backfill_missed(self) -> None:
+        while self._missed_messages:
+            await asyncio.sleep(BACKFILL_COLLECT_DELAY)
+            missed, self._missed_messages = self._missed_messages, []
+            try:
+                await self.backfill(missed)
+            except Exception:
+                self.log.exception(f"Failed to backfill {len(missed)} missed messages")
+
+    async def backfill(self, missed: List[MissedMessage]) -> None:
+        if self.mxid:
+            limit = self.config.snapshot.bridge.backfill.missed_event_limit
+        else:
+            user, _, _, info, _ = missed[-1]
+            if not await self.create_matrix_room(user, info):
+                self.log.warning(f"Failed to create room for {len(missed)} missed messages")
+                return
+            limit = self.config.snapshot.bridge.backfill.initial_nonthread_limit
+        missed.sort(key=lambda item: item[2].time)
+        if len(missed) > limit:
+            self.log.debug(f"Dropping {len(missed) - limit} oldest missed messages")
+            missed = missed[len(missed) - limit :]
+        page_size = max(1, self.config.snapshot.bridge.backfill.missed_event_page_size)
+        self.log.debug(f"Backfilling {len(missed)} missed messages")
+        for i in range(0, len(missed), page_size):
+            await self._backfill_page(missed[i : i + page_size])
+
+    @async_time(MESSAGE_STAGE_TIME.labels(stage="backfill"))
+    async def _backfill_page(self, page: List[MissedMessage]) -> None:
+        messages: List[ConvertedMessage] = []
+        for user, sender, msg, _, probably_handled in page:
+            if probably_handled and await self._is_handled(msg):
+                DEDUP_HITS.labels(source="database").inc()
+                continue
+            try:
+                content = await fmt.wechat_to_matrix(msg, self, self._msg_cache)
+            except Exception:
+                self.log.exception(f"Failed to convert missed message {msg.id}")
+                continue
+            messages.append((user, sender, msg, content))
+        if not messages:
+            return
+
+        event_ids = None
+        if not (self.encrypted and self.matrix.e2ee):
+            # Batch sends are inserted right after the last message that was bridged into the
+            # room before the first missed one, so that they end up before newer messages
+            prev = await DBMessage.get_last(self.mxid, int(messages[0][2].time.timestamp()))
+            if prev:
+                try:
+                    event_ids = await self._batch_send(prev.mxid, messages)
+                except Exception:
+                    self.log.warning(
+                        "Failed to batch send missed messages, sending them one by one",
+                        exc_info=True,
+                    )
+        if event_ids is None:
+            event_ids = []
+            for _, sender, msg, content in messages:
+                try:
+                    event_ids.append(
+                        await self._send_message(
+                            sender.intent_for(self), content, timestamp=msg.time
+                        )
+                    )
+                except Exception:
+                    self.log.exception(f"Failed to send missed message {msg.id}")
+                    event_ids.append(None)
+
+        rows = []
+        for (user, _, msg, _), event_id in zip(messages, event_ids):
+            if not event_id:
+                continue
+            if len(getattr(msg, "content", "")):
+                self._set_msg_cache(msg, event_id)
+            rows.append(
+                DBMessage(
+                    event_id,
+                    self.mxid,
+                    msg.id,
+                    msg.sender,
+                    msg.source,
+                    user.wxid,
+                    int(msg.time.timestamp()),
+                )
+            )
+        await DBMessage.insert_many(rows)
+
+    async def _batch_send(
+        self, prev_event_id: EventID, messages: List[ConvertedMessage]
+    ) -> List[EventID]:
+        events = []
+        members: Dict[UserID, BatchSendStateEvent] = {}
+        for _, sender, msg, content in messages:
+            intent = sender.intent_for(self)
+            if intent.api.is_real_user:
+                # Only appservice users can be used in batch sends
+                intent = sender.default_mxid_intent
+            timestamp = int(msg.time.timestamp() * 1000)
+            if intent.mxid not in members:
+                members[intent.mxid] = BatchSendStateEvent(
+                    content=MemberStateEventContent(
+                        Membership.JOIN,
+                        avatar_url=sender.avatar_url,
+                        displayname=(
+                            sender.get_displayname(sender.name, sender.wxid)
+                            if sender.name
+                            else None
+                        ),
+                    ),
+                    type=EventType.ROOM_MEMBER,
+                    sender=intent.mxid,
+                    timestamp=timestamp,
+                    state_key=intent.mxid,
+                )
+            events.append(
+                BatchSendEvent(
+                    content=content,
+                    type=EventType.ROOM_MESSAGE,
+                    sender=intent.mxid,
+                    timestamp=timestamp,
+                )
+            )
+        resp = await self.main_intent.batch_send(
+            self.mxid,
+            prev_event_id,
+            events=events,
+            state_events_at_start=list(members.values()),
+        )
+        return resp.event_ids
 
     def _get_invite_content(self, double_puppet: Optional[p.Puppet]) -> Dict[str, Any]:
         invite_content = {}
@@ -419,7 +843,7 @@ class Portal(DBPortal, BasePortal):
         return True
 
     async def _update_avatar(self, avatar_url: ContentURI, save: bool = False) -> bool:
-        if self.avatar_url == avatar_url:
+        if self.avatar_url == (avatar_url or None):
             return False
         self.avatar_url = avatar_url or None
         if self.avatar_url:
@@ -428,19 +852,23 @@ class Portal(DBPortal, BasePortal):
             await self.save()
         return True
 
+    def _info_changed(self, info: WechatUser, is_self: bool = False) -> bool:
+        # Compared against the stored values, so this doesn't need any Matrix calls
+        return (self._get_name(info, is_self), info.headimg or None) != (
+            self.name,
+            self.avatar_url,
+        )
+
     async def update_info(
         self, user: u.User, info: Optional[WechatUser] = None
     ) -> None:
+        if not info or not self._info_changed(info, user.wxid == self.wxid):
+            return
         changed = False
         self.log.debug(f"Updating portal info for {self.mxid} {self.name}")
         try:
-            if info:
-                # TODO: not sure if name and avatar need to be updated in this case
-                # becasue we're calling update_bridge_info anyway
-                changed = await self._update_name(
-                    self._get_name(info, user.wxid == self.wxid)
-                )
-                changed = await self._update_avatar(info.headimg) or changed
+            changed = await self._update_name(self._get_name(info, user.wxid == self.wxid))
+            changed = await self._update_avatar(info.headimg) or changed
         except Exception:
             self.log.exception(f"Failed to update info for {self.mxid}")
         if changed:
@@ -472,6 +900,7 @@ class Portal(DBPortal, BasePortal):
     ) -> Optional[RoomID]:
         if self.mxid:
             await self.update_matrix_room(user, info)
+            return self.mxid
 
         async with self._create_room_lock:
             try:
@@ -482,6 +911,7 @@ class Portal(DBPortal, BasePortal):
     async def _update_participants(self, source: u.User) -> None:
         pass
 
+    @async_time(MESSAGE_STAGE_TIME.labels(stage="create_room"))
     async def _create_matrix_room(
         self, user: u.User, info: Optional[WechatUser] = None
     ) -> Optional[RoomID]:
@@ -490,11 +920,7 @@ class Portal(DBPortal, BasePortal):
 
         self.log.debug(f"Creating matrix room for {self.wxid}")
 
-        puppet = await self.get_dm_puppet()
-        if puppet and info:
-            # TODO: not sure if this is needed
-            await puppet.update_info(info)
-
+        # The DM puppet's profile is filled in by the background profile refresher
         name = self.name = self._get_name(info, user.wxid == self.wxid)
 
         if info and info.headimg:
@@ -522,7 +948,7 @@ class Portal(DBPortal, BasePortal):
             },
         ]
         invites = []
-        if self.config["bridge.encryption.default"] and self.matrix.e2ee:
+        if self.config.snapshot.bridge.encryption.default and self.matrix.e2ee:
             self.encrypted = True
             initial_state.append(
                 {
@@ -534,7 +960,7 @@ class Portal(DBPortal, BasePortal):
                 invites.append(self.az.bot_mxid)
 
         creation_content = {}
-        if not self.config["bridge.federate_rooms"]:
+        if not self.config.snapshot.bridge.federate_rooms:
             creation_content["m.federate"] = False
         self.mxid = await self.main_intent.create_room(
             name=name,
@@ -559,10 +985,24 @@ class Portal(DBPortal, BasePortal):
         self.by_mxid[self.mxid] = self
         # await self._update_participants(source)
 
-        puppet = await p.Puppet.get_by_custom_mxid(user.mxid)
-        await self.main_intent.invite_user(
-            self.mxid, user.mxid, extra_content=self._get_invite_content(puppet)
-        )
+        # Messages can be sent before the user has joined, so don't make them wait for it
+        task = asyncio.create_task(self._invite_user(user))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        # if not self.is_direct:
+        #     await self._update_participants(source, info)
+        return self.mxid
+
+    @in_flight
+    async def _invite_user(self, user: u.User) -> None:
+        try:
+            puppet = await p.Puppet.get_by_custom_mxid(user.mxid)
+            await self.main_intent.invite_user(
+                self.mxid, user.mxid, extra_content=self._get_invite_content(puppet)
+            )
+        except Exception:
+            self.log.exception(f"Failed to invite {user.mxid} to newly created portal")
+            return
         if puppet:
             try:
                 puppet: p.Puppet
@@ -575,20 +1015,19 @@ class Portal(DBPortal, BasePortal):
                     "Failed to join custom puppet into newly created portal",
                     exc_info=True,
                 )
-        # if not self.is_direct:
-        #     await self._update_participants(source, info)
-        return self.mxid
 
+    @in_flight
     async def update_matrix_room(
         self, user: u.User, info: Optional[WechatUser] = None
     ) -> None:
         try:
             self.log.debug(f"Updating matrix room for {self.wxid}")
             puppet = await p.Puppet.get_by_custom_mxid(user.mxid)
-            # TODO: this is invite user no matter user has left or not
-            await self.main_intent.invite_user(
-                self.mxid, user.mxid, extra_content=self._get_invite_content(puppet)
-            )
+            membership = await self.main_intent.state_store.get_membership(self.mxid, user.mxid)
+            if membership not in (Membership.JOIN, Membership.INVITE):
+                await self.main_intent.invite_user(
+                    self.mxid, user.mxid, extra_content=self._get_invite_content(puppet)
+                )
 
             if puppet:
                 puppet: p.Puppet
@@ -608,5 +1047,14 @@ class Portal(DBPortal, BasePortal):
             try:
                 yield cls.by_wxid[(portal.wxid, portal.receiver)]
             except KeyError:
+                yield await portal._postinit()
+
+    @classmethod
+    async def preload(cls) -> int:
+        count = 0
+        portal: "Portal"
+        for portal in await super().all_with_room():
+            if (portal.wxid, portal.receiver) not in cls.by_wxid:
                 await portal._postinit()
-                yield portal
+                count += 1
+        return count
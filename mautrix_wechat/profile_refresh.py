@@ -0,0 +1,126 @@
+import time
+import heapq
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from mautrix.util.logging import TraceLogger
+from mautrix.util.opt_prometheus import Gauge
+from wesdk.types import WechatID, WechatUser
+
+from mautrix_wechat import puppet as pu
+
+if TYPE_CHECKING:
+    from .wechat import WechatHandler
+
+QUEUED_REFRESHES = Gauge(
+    "bridge_profile_refresh_queued", "Puppet profiles waiting to be refreshed", ["box"]
+)
+
+# Puppets that just sent a message are refreshed before puppets found by a contact sync
+PRIORITY_ACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+class PuppetProfileRefresher:
+    """
+    Background queue that refreshes puppet display names and avatars through one box.
+
+    Each puppet is refreshed at most once per ``bridge.puppet_profile_refresh.interval``
+    seconds, based on the refresh time stored in the database, or sooner if a contact sync saw
+    its name or avatar change. Refreshes are rate limited so that a burst of new senders doesn't
+    flood the homeserver with profile updates.
+    """
+
+    log: TraceLogger = logging.getLogger("mau.profile_refresh")
+
+    _queue: List[Tuple[int, int, int, WechatID]]
+    _queued: Dict[WechatID, int]
+    _task: Optional[asyncio.Task]
+    _wakeup: asyncio.Event
+
+    def __init__(self, handler: "WechatHandler") -> None:
+        self.handler = handler
+        self.config = handler.config
+        self.log = self.log.getChild(f"{handler.ip}:{handler.port}")
+        self._queue = []
+        self._queued = {}
+        self._counter = 0
+        self._task = None
+        self._wakeup = asyncio.Event()
+        QUEUED_REFRESHES.labels(box=handler.box).set_function(lambda: len(self._queued))
+
+    @property
+    def interval(self) -> int:
+        return self.config.snapshot.bridge.puppet_profile_refresh.interval
+
+    def is_stale(self, puppet: "pu.Puppet") -> bool:
+        return not puppet.name or puppet.profile_refreshed_at + self.interval < time.time()
+
+    def needs_refresh(self, puppet: "pu.Puppet", contact: Optional[WechatUser] = None) -> bool:
+        return self.is_stale(puppet) or puppet.profile_differs(contact)
+
+    def schedule(
+        self,
+        puppet: "pu.Puppet",
+        priority: int = PRIORITY_ACTIVE,
+        contact: Optional[WechatUser] = None,
+    ) -> None:
+        if not self.needs_refresh(puppet, contact):
+            return
+        queued = self._queued.get(puppet.wxid)
+        if queued is not None and queued <= priority:
+            return
+        self._queued[puppet.wxid] = priority
+        self._counter += 1
+        heapq.heappush(
+            self._queue, (priority, puppet.profile_refreshed_at, self._counter, puppet.wxid)
+        )
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def __len__(self) -> int:
+        return len(self._queued)
+
+    async def _run(self) -> None:
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            priority, _, _, wxid = heapq.heappop(self._queue)
+            if self._queued.get(wxid) != priority:
+                # Superseded by an entry with a higher priority
+                continue
+            del self._queued[wxid]
+            try:
+                changed = await self.refresh(wxid)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception(f"Failed to refresh profile of {wxid}")
+                changed = False
+            rate_limit = self.config.snapshot.bridge.puppet_profile_refresh.rate_limit
+            if changed and rate_limit > 0:
+                await asyncio.sleep(1 / rate_limit)
+
+    async def refresh(self, wxid: WechatID) -> bool:
+        puppet = await pu.Puppet.get_by_wxid(wxid)
+        contact = self.handler.get_contact(wxid)
+        if not puppet or not self.needs_refresh(puppet, contact):
+            return False
+        changed = await puppet.update_info(
+            contact,
+            await self.handler.get_personal_detail(wxid),
+            await self.handler.get_user_nick(wxid),
+            save=False,
+        )
+        puppet.profile_refreshed_at = int(time.time())
+        await puppet.save()
+        return changed
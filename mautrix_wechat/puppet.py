@@ -14,7 +14,7 @@ import asyncio
 from dataclasses import fields
 
 from yarl import URL
-from mautrix.bridge import BasePuppet, async_getter_lock
+from mautrix.bridge import BasePuppet
 from mautrix.appservice import IntentAPI
 from mautrix.types import UserID, SyncToken
 from mautrix.types import UserID, SyncToken, RoomID, ContentURI
@@ -22,7 +22,9 @@ from mautrix.util.simple_template import SimpleTemplate
 
 from mautrix_wechat.db import Puppet as DBPuppet, puppet
 from mautrix_wechat.config import Config
+from mautrix_wechat.util.eviction import IdleTracking, in_flight, select_evictable
 from mautrix_wechat.util.file import download_and_upload_file
+from mautrix_wechat.util.locks import StripedLock
 
 from mautrix_wechat import portal as p
 from wesdk.types import ChatRoomNick, WechatID, WechatUserDetail, WechatUser
@@ -31,11 +33,12 @@ if TYPE_CHECKING:
     from .__main__ import WechatBridge
 
 
-class Puppet(DBPuppet, BasePuppet):
+class Puppet(DBPuppet, BasePuppet, IdleTracking):
     config: Config
 
     by_wxid: Dict[WechatID, "Puppet"] = {}
     by_custom_mxid: Dict[UserID, "Puppet"] = {}
+    _getter_lock: StripedLock = StripedLock()
     hs_domain: str
     mxid_template: SimpleTemplate[str]
     displayname_template: str
@@ -54,6 +57,7 @@ class Puppet(DBPuppet, BasePuppet):
         next_batch: Optional[SyncToken] = None,
         base_url: Optional[URL] = None,
         avatar_url: Optional[ContentURI] = None,
+        profile_refreshed_at: int = 0,
     ) -> None:
         super().__init__(
             wxid=wxid,
@@ -67,6 +71,7 @@ class Puppet(DBPuppet, BasePuppet):
             next_batch=next_batch,
             base_url=base_url,
             avatar_url=avatar_url,
+            profile_refreshed_at=profile_refreshed_at,
         )
         self.default_mxid = self.get_mxid_from_wxid(wxid, wxcode)
         self.default_mxid_intent = self.az.intent.user(self.default_mxid)
@@ -90,14 +95,35 @@ class Puppet(DBPuppet, BasePuppet):
         )
         cls.displayname_template = cls.config["bridge.displayname_template"]
 
-    def _postinit(self) -> None:
-        self.by_wxid[self.wxid] = self
-        if self.custom_mxid:
-            self.by_custom_mxid[self.custom_mxid] = self
+    def _postinit(self) -> "Puppet":
+        # If another lookup loaded the same puppet in the meantime, that instance wins
+        puppet = self.by_wxid.setdefault(self.wxid, self)
+        if puppet.custom_mxid:
+            self.by_custom_mxid.setdefault(puppet.custom_mxid, puppet)
+        puppet.touch()
+        return puppet
+
+    @property
+    def is_busy(self) -> bool:
+        return super().is_busy or self.is_dirty
+
+    @classmethod
+    def evict_idle(cls, max_idle: float, max_size: int = 0, min_idle: float = 60) -> int:
+        # Double puppets run their own sync loop, so they stay in memory
+        puppets = select_evictable(
+            [puppet for puppet in cls.by_wxid.values() if not puppet.custom_mxid],
+            max_idle,
+            max_size,
+            min_idle,
+        )
+        for puppet in puppets:
+            if cls.by_wxid.get(puppet.wxid) is puppet:
+                del cls.by_wxid[puppet.wxid]
+        return len(puppets)
 
     async def _update_avatar(self, headimg: str) -> bool:
         if headimg and headimg != self.headimg:
-            self.log.debug(f"prev: {self.headimg} now: {headimg}")
+            self.log.debug("Avatar changed from %s to %s", self.headimg, headimg)
             if headimg:
                 photo_mxc = await download_and_upload_file(
                     headimg, self.default_mxid_intent, self.config
@@ -129,27 +155,28 @@ class Puppet(DBPuppet, BasePuppet):
                 return True
         return False
 
+    @in_flight
     async def update_info(
         self,
         wechat_user: WechatUser = None,
         wechat_user_detail: WechatUserDetail = None,
         chat_room_nick: ChatRoomNick = None,
-    ) -> None:
-        self.log.debug(
-            f"Updating info, WechatUser: {wechat_user}, WechatUserDetail: {wechat_user_detail}, ChatRoomNick: {chat_room_nick}"
+        save: bool = True,
+    ) -> bool:
+        self.log.trace(
+            "Updating info, WechatUser: %s, WechatUserDetail: %s, ChatRoomNick: %s",
+            wechat_user,
+            wechat_user_detail,
+            chat_room_nick,
         )
         changed: bool = False
         name = None
         if chat_room_nick and chat_room_nick.nick:
             name = chat_room_nick.nick
         if wechat_user:
-            for field in fields(WechatUser):
-                if val := getattr(wechat_user, field.name):
-                    if field.name == "name":
-                        name = val
-                    elif val != getattr(self, field.name):
-                        setattr(self, field.name, val)
-        changed = await self._update_name(name)
+            changed = self.update_contact_info(wechat_user)
+            name = wechat_user.name or name
+        changed = await self._update_name(name) or changed
 
         headimg = None
         if wechat_user and wechat_user.headimg:
@@ -169,8 +196,31 @@ class Puppet(DBPuppet, BasePuppet):
             if detail_headimg and detail_headimg != self.headimg:
                 headimg = wechat_user_detail.little_headimg
         changed = await self._update_avatar(headimg) or changed
-        if changed:
+        if changed and save:
             await self.save()
+        return changed
+
+    def update_contact_info(self, wechat_user: WechatUser) -> bool:
+        """
+        Copy the contact fields that aren't part of the Matrix profile, without saving.
+
+        The name and avatar are only changed by :meth:`update_info`, which also updates them on
+        Matrix.
+        """
+        changed = False
+        for field in fields(WechatUser):
+            if field.name in ("wxid", "chat_room_members", "headimg", "name"):
+                continue
+            if (val := getattr(wechat_user, field.name)) and val != getattr(self, field.name):
+                setattr(self, field.name, val)
+                changed = True
+        return changed
+
+    def profile_differs(self, wechat_user: Optional[WechatUser]) -> bool:
+        return bool(wechat_user) and (
+            bool(wechat_user.name and wechat_user.name != self.name)
+            or bool(wechat_user.headimg and wechat_user.headimg != self.headimg)
+        )
 
     def intent_for(self, portal: "p.Portal") -> IntentAPI:
         if portal.wxid == self.wxid:
@@ -178,24 +228,48 @@ class Puppet(DBPuppet, BasePuppet):
         return self.intent
 
     @classmethod
-    @async_getter_lock
     async def get_by_wxid(
         cls, wxid: WechatID, create: bool = False
     ) -> Optional["Puppet"]:
-        if wxid in cls.by_wxid:
-            return cls.by_wxid[wxid]
-
-        puppet = cast(Puppet, await super().get_by_wxid(wxid))
-        if puppet:
-            puppet._postinit()
-        elif create:
-            puppet = cls(wxid)
-            await puppet.insert()
-            puppet._postinit()
-        return puppet
+        try:
+            puppet = cls.by_wxid[wxid]
+            puppet.touch()
+            return puppet
+        except KeyError:
+            pass
+
+        async with cls._getter_lock(wxid):
+            try:
+                return cls.by_wxid[wxid]
+            except KeyError:
+                pass
+
+            puppet = cast(Puppet, await super().get_by_wxid(wxid))
+            if puppet:
+                return puppet._postinit()
+            elif create:
+                puppet = cls(wxid)
+                await puppet.insert()
+                return puppet._postinit()
+            return None
+
+    @classmethod
+    async def get_all(cls) -> Dict[WechatID, "Puppet"]:
+        puppets = {}
+        puppet: "Puppet"
+        for puppet in await super().all():
+            try:
+                puppet = cls.by_wxid[puppet.wxid]
+            except KeyError:
+                puppet = puppet._postinit()
+            puppets[puppet.wxid] = puppet
+        return puppets
+
+    @classmethod
+    async def preload(cls) -> int:
+        return len(await cls.get_all())
 
     @classmethod
-    @async_getter_lock
     async def get_by_mxid(
         cls, mxid: UserID, create: bool = False
     ) -> Optional["Puppet"]:
@@ -205,14 +279,22 @@ class Puppet(DBPuppet, BasePuppet):
         return None
 
     @classmethod
-    @async_getter_lock
     async def get_by_custom_mxid(cls, mxid: UserID) -> Optional["Puppet"]:
-        if mxid in cls.by_custom_mxid:
+        try:
             return cls.by_custom_mxid[mxid]
-        puppet = cast(Puppet, await super().get_by_custom_mxid(mxid))
-        if puppet:
-            puppet._postinit()
-        return puppet
+        except KeyError:
+            pass
+
+        async with cls._getter_lock(mxid):
+            try:
+                return cls.by_custom_mxid[mxid]
+            except KeyError:
+                pass
+
+            puppet = cast(Puppet, await super().get_by_custom_mxid(mxid))
+            if puppet:
+                return puppet._postinit()
+            return None
 
     @classmethod
     def get_id_from_mxid(cls, mxid: UserID) -> Optional[str]:
@@ -0,0 +1,83 @@
+import time
+import asyncio
+import logging
+from typing import Optional, TYPE_CHECKING
+
+from mautrix.util.async_db import Scheme
+from mautrix.util.logging import TraceLogger
+
+from mautrix_wechat.config import Config
+from mautrix_wechat.db import Message as DBMessage
+
+if TYPE_CHECKING:
+    from .__main__ import WechatBridge
+
+
+class MessageRetention:
+    """Background job that prunes message mappings older than ``bridge.message_retention.max_age``."""
+
+    log: TraceLogger = logging.getLogger("mau.retention")
+    config: Config
+
+    _task: Optional[asyncio.Task]
+
+    def __init__(self, bridge: "WechatBridge") -> None:
+        self.config = bridge.config
+        self.loop = bridge.loop
+        self._task = None
+
+    @property
+    def max_age(self) -> int:
+        return self.config.snapshot.bridge.message_retention.max_age * 24 * 60 * 60
+
+    async def start(self) -> None:
+        partitioned = await DBMessage.is_partitioned()
+        if self.config.snapshot.bridge.message_retention.partition_by_month and not partitioned:
+            if DBMessage.db.scheme != Scheme.POSTGRES:
+                self.log.warning("Partitioning the message table is only supported on Postgres")
+            else:
+                self.log.info("Partitioning message table by month, this may take a while")
+                await DBMessage.partition_by_month()
+                self.log.info("Finished partitioning message table")
+                partitioned = True
+        if partitioned or self.max_age > 0:
+            self._task = self.loop.create_task(self._run(partitioned))
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self, partitioned: bool) -> None:
+        interval = self.config.snapshot.bridge.message_retention.prune_interval
+        while True:
+            try:
+                if partitioned:
+                    await DBMessage.ensure_month_partitions(int(time.time()))
+                if self.max_age > 0:
+                    await self.prune(partitioned)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception("Failed to prune old messages")
+            await asyncio.sleep(interval)
+
+    async def prune(self, partitioned: bool = False) -> int:
+        before = int(time.time()) - self.max_age
+        if partitioned:
+            for name in await DBMessage.drop_partitions_before(before):
+                self.log.info(f"Dropped expired message partition {name}")
+
+        batch_size = self.config.snapshot.bridge.message_retention.prune_batch_size
+        batch_delay = self.config.snapshot.bridge.message_retention.prune_batch_delay
+        total = 0
+        while True:
+            deleted = await DBMessage.prune(before, batch_size)
+            total += deleted
+            if deleted < batch_size:
+                break
+            # Yield to live traffic between batches
+            await asyncio.sleep(batch_delay)
+        if total:
+            self.log.debug(f"Pruned {total} messages older than {before}")
+        return total
@@ -0,0 +1,139 @@
+import time
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from mautrix.util.logging import TraceLogger
+from mautrix.util.opt_prometheus import Counter
+from wesdk.types import WechatID
+
+from mautrix_wechat.config import Config
+
+if TYPE_CHECKING:
+    from .wechat import WechatHandler
+
+RELAY_ROUTES = Counter(
+    "bridge_relay_routes", "Relayed messages routed through each box", ["box"]
+)
+RELAY_FAILOVERS = Counter(
+    "bridge_relay_failovers", "Times a chat was moved to another box", ["reason"]
+)
+RELAY_ECHOES = Counter(
+    "bridge_relay_echoes", "Relayed messages that other boxes received back and dropped"
+)
+
+# Seconds to wait for a relayed message to come back through the portal's own box
+ECHO_TTL = 120
+
+# (chat, portal's box account, sending box account)
+EchoKey = Tuple[WechatID, WechatID, WechatID]
+
+
+class RelayRouter:
+    """
+    Picks the box that sends relayed messages to a group chat.
+
+    Any relay box whose account is a member of the chat can send to it. Healthy boxes are
+    compared by queue depth, with the recent send rate as a tie breaker. A chat sticks to the
+    box it was last routed through, unless that box stops being healthy or has more than
+    ``wechat.relay_routing.stickiness`` messages more queued than the best one, so that
+    consecutive messages usually go out through the same account and stay in order. A box is
+    unhealthy when it's disconnected, logged out or its heartbeat lapsed.
+
+    When a message for one box's portal goes out through another box, the portal's own box
+    receives it back from the other account. Such sends are recorded with :meth:`expect_echo`
+    so that :meth:`is_echo` can recognize the copy instead of bridging it into the room again.
+    """
+
+    log: TraceLogger = logging.getLogger("mau.routing")
+
+    _routes: Dict[WechatID, "WechatHandler"]
+    _echoes: Dict[EchoKey, Deque[Tuple[float, str]]]
+
+    def __init__(self, config: Config, handlers: List["WechatHandler"]) -> None:
+        self.config = config
+        self.handlers = handlers
+        self._routes = {}
+        self._echoes = {}
+        self._echoes_expired_at = time.monotonic()
+
+    @staticmethod
+    def is_healthy(handler: "WechatHandler") -> bool:
+        if not handler.connected or not handler.logged_in:
+            return False
+        last_heart_beat = handler.last_heart_beat_at
+        return (
+            last_heart_beat is None
+            or time.monotonic() - last_heart_beat < handler.heart_beat_timeout
+        )
+
+    def candidates(self, chat: WechatID) -> List["WechatHandler"]:
+        return [
+            handler
+            for handler in self.handlers
+            if handler.can_relay and handler.get_contact(chat) and self.is_healthy(handler)
+        ]
+
+    def route(
+        self, chat: WechatID, preferred: Optional["WechatHandler"] = None
+    ) -> Optional["WechatHandler"]:
+        if not self.config.snapshot.wechat.relay_routing.enabled:
+            return preferred
+        candidates = self.candidates(chat)
+        if preferred and self.is_healthy(preferred) and preferred not in candidates:
+            candidates.append(preferred)
+        if not candidates:
+            # Nothing healthy, queue it on the usual box until it comes back
+            return preferred
+
+        best = min(
+            candidates, key=lambda handler: (handler.outbound.load, handler.outbound.send_rate)
+        )
+        current = self._routes.get(chat, preferred)
+        if current in candidates:
+            stickiness = self.config.snapshot.wechat.relay_routing.stickiness
+            if current.outbound.load <= best.outbound.load + stickiness:
+                best = current
+            reason = "load"
+        else:
+            reason = "unavailable"
+        if current is not None and best is not current:
+            RELAY_FAILOVERS.labels(reason=reason).inc()
+            self.log.info("Routing relayed messages to %s through %s (%s)", chat, best.box, reason)
+        self._routes[chat] = best
+        RELAY_ROUTES.labels(box=best.box).inc()
+        return best
+
+    def expect_echo(
+        self, chat: WechatID, receiver: WechatID, sender: WechatID, text: str
+    ) -> None:
+        """Remember that box account ``sender`` sends ``text`` for the portal of ``receiver``."""
+        now = time.monotonic()
+        if now - self._echoes_expired_at > ECHO_TTL:
+            self._expire_echoes(now)
+        self._echoes.setdefault((chat, receiver, sender), deque()).append((now + ECHO_TTL, text))
+
+    def is_echo(self, chat: WechatID, receiver: WechatID, sender: WechatID, content: str) -> bool:
+        """Check whether a received message is the copy of a message sent through another box."""
+        echoes = self._echoes.get((chat, receiver, sender))
+        if not echoes:
+            return False
+        now = time.monotonic()
+        for item in echoes:
+            expires_at, text = item
+            # Messages with a mention come back with the mention in front of the text
+            if expires_at >= now and content.endswith(text):
+                echoes.remove(item)
+                if not echoes:
+                    del self._echoes[(chat, receiver, sender)]
+                RELAY_ECHOES.inc()
+                return True
+        return False
+
+    def _expire_echoes(self, now: float) -> None:
+        self._echoes_expired_at = now
+        for key, echoes in list(self._echoes.items()):
+            while echoes and echoes[0][0] < now:
+                echoes.popleft()
+            if not echoes:
+                del self._echoes[key]
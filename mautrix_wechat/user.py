@@ -8,7 +8,7 @@ from typing import (TYPE_CHECKING, AsyncGenerator, AsyncIterable, Awaitable, Dic
 from uuid import UUID
 
 from mautrix.appservice import AppService
-from mautrix.bridge import AutologinError, BaseUser, async_getter_lock
+from mautrix.bridge import AutologinError, BaseUser
 from mautrix.types import RoomID, UserID
 from mautrix.util.bridge_state import BridgeState, BridgeStateEvent
 from mautrix.util.logging import TraceLogger
@@ -21,14 +21,18 @@ from mautrix_wechat import portal as po
 from mautrix_wechat import puppet as pu
 from mautrix_wechat.config import Config
 from mautrix_wechat.db import User as DBUser
+from mautrix_wechat.util.locks import StripedLock
 
 if TYPE_CHECKING:
     from .__main__ import WechatBridge
 
+METRIC_LOGGED_IN = Gauge("bridge_logged_in", "Users logged into the bridge")
+
 
 class User(DBUser, BaseUser):
     by_mxid: Dict[UserID, "User"] = {}
     by_wxid: Dict[WechatID, "User"] = {}
+    _getter_lock: StripedLock = StripedLock()
     config: Config
     az: AppService
     loop: asyncio.AbstractEventLoop
@@ -64,43 +68,77 @@ class User(DBUser, BaseUser):
         cls.config = bridge.config
         cls.az = bridge.az
         cls.loop = bridge.loop
+        # Counted when scraped, so logouts and box disconnects are reflected too
+        METRIC_LOGGED_IN.set_function(
+            lambda: sum(1 for user in cls.by_mxid.values() if user.is_connected_and_logged_in)
+        )
 
-    def _postinit(self) -> None:
-        self.by_mxid[self.mxid] = self
-        if self.wxid:
-            self.by_wxid[self.wxid] = self
+    def _postinit(self) -> "User":
+        # If another lookup loaded the same user in the meantime, that instance wins
+        user = self.by_mxid.setdefault(self.mxid, self)
+        if user.wxid:
+            self.by_wxid.setdefault(user.wxid, user)
+        return user
 
     def login_complete(self, client: WechatClient) -> None:
         self.client = client
 
+    @property
+    def is_connected_and_logged_in(self) -> bool:
+        return bool(self.client and self.client.connected and self.client.logged_in)
+
     @classmethod
-    @async_getter_lock
     async def get_by_mxid(cls, mxid: UserID, create: bool = False) -> Optional["User"]:
         if pu.Puppet.get_id_from_mxid(mxid) or mxid == cls.az.bot_mxid:
             return None
 
-        if mxid in cls.by_mxid:
+        try:
             return cls.by_mxid[mxid]
-
-        user = cast(cls, await super().get_by_mxid(mxid))
-        if user:
-            user._postinit()
-        elif create:
-            user = cls(mxid)
-            await user.insert()
-            user._postinit()
-        return user
+        except KeyError:
+            pass
+
+        async with cls._getter_lock(mxid):
+            try:
+                return cls.by_mxid[mxid]
+            except KeyError:
+                pass
+
+            user = cast(cls, await super().get_by_mxid(mxid))
+            if user:
+                return user._postinit()
+            elif create:
+                user = cls(mxid)
+                await user.insert()
+                return user._postinit()
+            return None
 
     @classmethod
-    @async_getter_lock
     async def get_by_wxid(cls, wxid: WechatID) -> Optional["User"]:
-        if wxid in cls.by_wxid:
-            return cls.by_wxid
+        try:
+            return cls.by_wxid[wxid]
+        except KeyError:
+            pass
+
+        async with cls._getter_lock(wxid):
+            try:
+                return cls.by_wxid[wxid]
+            except KeyError:
+                pass
+
+            user = cast(cls, await super().get_by_wxid(wxid))
+            if user:
+                return user._postinit()
+            return None
 
-        user = cast(cls, await super().get_by_wxid(wxid))
-        if user:
-            user._postinit()
-        return user
+    @classmethod
+    async def preload(cls) -> int:
+        count = 0
+        user: "User"
+        for user in await super().all_logged_in():
+            if user.mxid not in cls.by_mxid:
+                user._postinit()
+                count += 1
+        return count
 
     async def is_logged_in(self) -> bool:
         return self.client.logged_in
@@ -0,0 +1,170 @@
+import math
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Hashable, Optional, Set, Tuple
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter using double hashing over a single blake2b digest."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01) -> None:
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str) -> None:
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class DedupWindow:
+    """
+    Bounded set of recently handled message keys.
+
+    Membership in the window is a definite hit. Keys that fell out of the window are remembered
+    by an optional pair of rotating Bloom filters, which are only allocated once the first key
+    falls out, so that the many portals that rarely get messages don't pay for them, and so :meth:`maybe_seen` can tell callers when a
+    (more expensive) authoritative lookup is worth doing. Messages that arrive within
+    ``grace_period`` seconds of the window being created, and messages that are older than that
+    or of unknown age, are always reported as probable hits, as they may have been handled
+    before a restart or before the window was created.
+    """
+
+    _keys: Set[Hashable]
+    _order: Deque[Hashable]
+    _bloom: Optional[BloomFilter]
+    _prev_bloom: Optional[BloomFilter]
+
+    def __init__(
+        self,
+        maxlen: int = 100,
+        bloom_capacity: int = 0,
+        bloom_error_rate: float = 0.01,
+        grace_period: float = 60,
+    ) -> None:
+        self.maxlen = maxlen
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.grace_period = grace_period
+        self._grace_until = time.monotonic() + grace_period
+        self._keys = set()
+        self._order = deque()
+        self._bloom = None
+        self._prev_bloom = None
+
+    @staticmethod
+    def _bloom_key(key: Hashable) -> str:
+        if isinstance(key, tuple):
+            return "\x00".join(str(part) for part in key)
+        return str(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def maybe_seen(self, key: Hashable, age: Optional[float] = None) -> bool:
+        """
+        Check whether the key may have been added before.
+
+        :param age: Seconds since the message was sent, measured on the clock of whatever
+                    produced its timestamp, or ``None`` if it's unknown.
+        """
+        if key in self._keys:
+            return True
+        if age is None or age > self.grace_period or time.monotonic() < self._grace_until:
+            return True
+        if self._bloom is None:
+            return False
+        bloom_key = self._bloom_key(key)
+        return bloom_key in self._bloom or (
+            self._prev_bloom is not None and bloom_key in self._prev_bloom
+        )
+
+    def add(self, key: Hashable) -> None:
+        if key in self._keys:
+            return
+        self._keys.add(key)
+        self._order.append(key)
+        while len(self._order) > self.maxlen:
+            evicted = self._order.popleft()
+            self._keys.discard(evicted)
+            self._remember(evicted)
+
+    def _remember(self, key: Hashable) -> None:
+        if self.bloom_capacity <= 0:
+            return
+        if self._bloom is None or self._bloom.count >= self.bloom_capacity:
+            self._prev_bloom = self._bloom
+            self._bloom = BloomFilter(self.bloom_capacity, self.bloom_error_rate)
+        self._bloom.add(self._bloom_key(key))
+
+
+def content_hash(content: Any) -> str:
+    return hashlib.blake2b(str(content).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class MessageClaim:
+    """The first sighting of a message in a :class:`RecentMessageIndex`."""
+
+    def __init__(self) -> None:
+        self.created_at = time.monotonic()
+        # Resolved with whatever the first handler produced for the message, or None
+        self.result = asyncio.get_running_loop().create_future()
+        # Rooms the message was bridged to, and the box that bridged it to each of them
+        self.rooms: Dict[str, str] = {}
+
+    def resolve(self, result: Any) -> None:
+        if not self.result.done():
+            self.result.set_result(result)
+
+
+class RecentMessageIndex:
+    """
+    Bounded index of recently received messages, shared by all boxes.
+
+    The first caller to :meth:`claim` a key gets ``True`` and is expected to resolve the claim
+    with its result; later callers get the same claim and can wait for that result instead of
+    redoing the work. At most ``maxlen`` claims younger than ``ttl`` seconds are kept.
+    """
+
+    _claims: "OrderedDict[Hashable, MessageClaim]"
+
+    def __init__(self, maxlen: int = 10000, ttl: float = 300) -> None:
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self._claims = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._claims)
+
+    def claim(self, key: Hashable) -> Tuple[MessageClaim, bool]:
+        self._expire()
+        try:
+            return self._claims[key], False
+        except KeyError:
+            claim = self._claims[key] = MessageClaim()
+            return claim, True
+
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - self.ttl
+        while self._claims:
+            oldest = next(iter(self._claims.values()))
+            if len(self._claims) < self.maxlen and oldest.created_at >= cutoff:
+                break
+            self._claims.popitem(last=False)
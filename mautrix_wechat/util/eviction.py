@@ -0,0 +1,68 @@
+import time
+import functools
+from typing import Any, Awaitable, Callable, List, Sequence, TypeVar
+
+
+class IdleTracking:
+    """Mixin for cached objects that records when they were last used and whether they're busy."""
+
+    _last_used: float = 0
+    _in_flight: int = 0
+
+    def touch(self) -> None:
+        self._last_used = time.monotonic()
+
+    @property
+    def idle_time(self) -> float:
+        return time.monotonic() - self._last_used
+
+    @property
+    def is_busy(self) -> bool:
+        return self._in_flight > 0
+
+
+T = TypeVar("T", bound=IdleTracking)
+Method = Callable[..., Awaitable[Any]]
+
+
+def in_flight(fn: Method) -> Method:
+    """Mark an ``IdleTracking`` object as busy while the wrapped coroutine method runs."""
+
+    @functools.wraps(fn)
+    async def wrapper(self: IdleTracking, *args: Any, **kwargs: Any) -> Any:
+        self._in_flight += 1
+        try:
+            return await fn(self, *args, **kwargs)
+        finally:
+            self._in_flight -= 1
+            self.touch()
+
+    return wrapper
+
+
+def select_evictable(
+    objects: Sequence[T], max_idle: float, max_size: int, min_idle: float
+) -> List[T]:
+    """
+    Pick the objects to evict from a cache, least recently used first.
+
+    Objects idle for longer than ``max_idle`` seconds are always picked. If more than
+    ``max_size`` objects would remain, further objects are picked as long as they have been idle
+    for at least ``min_idle`` seconds. Busy objects are never picked. Zero disables a limit.
+    """
+    now = time.monotonic()
+    candidates = sorted((obj for obj in objects if not obj.is_busy), key=lambda o: o._last_used)
+    count = 0
+    if max_idle > 0:
+        while count < len(candidates) and now - candidates[count]._last_used > max_idle:
+            count += 1
+    if max_size > 0:
+        excess = len(objects) - count - max_size
+        while (
+            excess > 0
+            and count < len(candidates)
+            and now - candidates[count]._last_used >= min_idle
+        ):
+            count += 1
+            excess -= 1
+    return candidates[:count]
@@ -4,11 +4,16 @@ from typing import AsyncIterable, Union, Optional
 import aiohttp
 from yarl import URL
 from mautrix.util.magic import mimetype
+from mautrix.util.opt_prometheus import Histogram, async_time
 from mautrix.types import ContentURI
 from mautrix_wechat.config import Config
 from mautrix.appservice import IntentAPI
 
 
+UPLOAD_TIME = Histogram("bridge_media_upload_seconds", "Time spent uploading media", ["source"])
+
+
+@async_time(UPLOAD_TIME.labels(source="file"))
 async def upload_file(
     data: Union[bytes,bytearray,AsyncIterable[bytes]], intent: IntentAPI, config: Config, filename: Optional[str] = None
 ) -> ContentURI:
@@ -17,9 +22,11 @@ async def upload_file(
             data,
             mime_type=mime,
             filename=filename,
-            async_upload=config["homeserver.async_media"],
+            async_upload=config.snapshot.homeserver.async_media,
         )
 
+
+@async_time(UPLOAD_TIME.labels(source="url"))
 async def download_and_upload_file(
     url: str, intent: IntentAPI, config: Config, filename: Optional[str] = None
 ) -> ContentURI:
@@ -31,5 +38,5 @@ async def download_and_upload_file(
             data,
             mime_type=mime,
             filename=filename,
-            async_upload=config["homeserver.async_media"],
+            async_upload=config.snapshot.homeserver.async_media,
         )
\ No newline at end of file
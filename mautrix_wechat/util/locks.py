@@ -1,5 +1,5 @@
 from asyncio import Lock
-from typing import Dict
+from typing import Dict, Hashable
 from collections import defaultdict
 
 from wesdk.types import WechatID
@@ -27,3 +27,27 @@ class PortalSendLock:
             return self._send_locks[wxid]
         except KeyError:
             return self._send_locks.setdefault(wxid, Lock()) if required else self._noop_lock
+
+    @property
+    def locked(self) -> bool:
+        return any(lock.locked() for lock in self._send_locks.values())
+
+
+class StripedLock:
+    """
+    A fixed number of locks shared between keys by hash, so that lookups of unrelated keys
+    rarely wait on each other while the number of locks stays bounded.
+    """
+
+    _locks: Dict[int, Lock]
+
+    def __init__(self, stripes: int = 64) -> None:
+        self.stripes = stripes
+        self._locks = {}
+
+    def __call__(self, key: Hashable) -> Lock:
+        index = hash(key) % self.stripes
+        try:
+            return self._locks[index]
+        except KeyError:
+            return self._locks.setdefault(index, Lock())
@@ -0,0 +1,46 @@
+import time
+import logging
+from typing import Dict, List
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Logging filter that rate limits repetitive records.
+
+    Records logged with ``extra={"sample": "<category>"}`` get through at most ``burst`` times
+    per ``period`` seconds for each category. The rest are dropped and counted, and the count is
+    added to the first record of the category that gets through afterwards. Records without a
+    category are never dropped.
+    """
+
+    _windows: Dict[str, List]
+
+    def __init__(self, burst: int = 10, period: float = 60, name: str = "") -> None:
+        super().__init__(name)
+        self.burst = burst
+        self.period = period
+        self._windows = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = getattr(record, "sample", None)
+        if category is None:
+            return True
+        # The same filter instance may be attached to several handlers
+        decision = getattr(record, "_sampled", None)
+        if decision is not None:
+            return decision
+
+        now = time.monotonic()
+        window = self._windows.get(category)
+        if window is None or now - window[0] >= self.period:
+            dropped = window[2] if window else 0
+            window = self._windows[category] = [now, 0, 0]
+            if dropped:
+                record.msg = f"{record.msg} ({dropped} similar messages were dropped)"
+        if window[1] < self.burst:
+            window[1] += 1
+            record._sampled = True
+        else:
+            window[2] += 1
+            record._sampled = False
+        return record._sampled
@@ -0,0 +1,110 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from types import FrameType
+from typing import Dict, Optional
+
+from mautrix.util.logging import TraceLogger
+from mautrix.util.opt_prometheus import Counter, Histogram
+from wesdk.client import WechatClient
+from wesdk.types import Message as WechatMessage
+
+LOOP_LAG = Histogram(
+    "bridge_event_loop_lag_seconds",
+    "How late the event loop ran a timer that was due",
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+)
+LOOP_STALLS = Counter("bridge_event_loop_stalls", "Times a single step blocked the event loop")
+
+
+def describe_frame(frame: Optional[FrameType]) -> Dict[str, str]:
+    """Find the box, portal and message that the code running in a stack is working on."""
+    context = {}
+    while frame is not None:
+        f_locals = frame.f_locals
+        obj = f_locals.get("self")
+        if isinstance(obj, WechatClient):
+            context.setdefault("box", obj.box)
+        elif obj is not None and hasattr(obj, "receiver") and hasattr(obj, "wxid"):
+            context.setdefault("portal", f"{obj.wxid}/{obj.receiver}")
+        msg = f_locals.get("msg")
+        if isinstance(msg, WechatMessage):
+            context.setdefault("message", f"{type(msg).__name__} {msg.id}")
+        elif isinstance(msg, dict) and "type" in msg:
+            context.setdefault("message", f"raw type {msg['type']}")
+        frame = frame.f_back
+    return context
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag and reports steps that block the loop.
+
+    A task on the loop wakes up every ``interval`` seconds and records how late it was woken.
+    A watchdog thread checks that those wakeups keep happening; if the loop doesn't get to one
+    for ``stall_threshold`` seconds, it samples the stack of the loop thread and logs it along
+    with the box, portal and message being handled.
+    """
+
+    log: TraceLogger = logging.getLogger("mau.loop_monitor")
+
+    _task: Optional[asyncio.Task]
+    _thread: Optional[threading.Thread]
+
+    def __init__(
+        self, loop: asyncio.AbstractEventLoop, interval: float = 0.25, stall_threshold: float = 1
+    ) -> None:
+        self.loop = loop
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self._last_tick = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._task = self.loop.create_task(self._sample())
+        if self.stall_threshold > 0:
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._watch, name="loop-watchdog", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _sample(self) -> None:
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(0.0, self.loop.time() - start - self.interval))
+            self._last_tick = time.monotonic()
+
+    def _watch(self) -> None:
+        reported_tick = None
+        while not self._stopped.wait(self.stall_threshold / 4):
+            tick = self._last_tick
+            blocked = time.monotonic() - tick - self.interval
+            if blocked < self.stall_threshold or tick == reported_tick:
+                continue
+            reported_tick = tick
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            context = describe_frame(frame)
+            stack = "".join(traceback.format_stack(frame, limit=20)) if frame else ""
+            self.log.warning(
+                "Event loop blocked for over %.2f seconds (%s), loop thread stack:\n%s",
+                blocked,
+                ", ".join(f"{key}={value}" for key, value in context.items()) or "no context",
+                stack,
+            )
@@ -0,0 +1,76 @@
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Optional, Tuple
+
+Deliver = Callable[[Any], Awaitable[Any]]
+Finish = Callable[[Any], Awaitable[None]]
+QueuedItem = Tuple[asyncio.Task, Deliver, Optional[Finish], asyncio.Future]
+
+
+class OrderedPipeline:
+    """
+    Three-stage pipeline that keeps the middle stage in submission order.
+
+    The prepare step of every submitted item starts right away and runs concurrently with the
+    others (limited by ``max_concurrent``). The deliver steps then run one at a time, in the
+    order the items were submitted, and the optional finish steps run concurrently again once
+    their item has been delivered. The future returned by :meth:`submit` resolves with the
+    result of the deliver step after the finish step is done, or with the first exception.
+    """
+
+    _queue: Deque[QueuedItem]
+    _worker: Optional[asyncio.Task]
+    _semaphore: Optional[asyncio.Semaphore]
+
+    def __init__(self, max_concurrent: int = 0) -> None:
+        self._queue = deque()
+        self._worker = None
+        self._semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent > 0 else None
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def submit(
+        self,
+        prepare: Awaitable[Any],
+        deliver: Deliver,
+        finish: Optional[Finish] = None,
+    ) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.append((asyncio.create_task(self._prepare(prepare)), deliver, finish, fut))
+        if not self._worker or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return fut
+
+    async def _prepare(self, prepare: Awaitable[Any]) -> Any:
+        if not self._semaphore:
+            return await prepare
+        async with self._semaphore:
+            return await prepare
+
+    async def _run(self) -> None:
+        while self._queue:
+            prepared, deliver, finish, fut = self._queue[0]
+            try:
+                result = await deliver(await prepared)
+            except Exception as e:
+                self._queue.popleft()
+                if not fut.done():
+                    fut.set_exception(e)
+                continue
+            self._queue.popleft()
+            if finish:
+                asyncio.create_task(self._finish(finish, result, fut))
+            elif not fut.done():
+                fut.set_result(result)
+
+    @staticmethod
+    async def _finish(finish: Finish, result: Any, fut: asyncio.Future) -> None:
+        try:
+            await finish(result)
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+        else:
+            if not fut.done():
+                fut.set_result(result)
@@ -1,17 +1,21 @@
 import asyncio
 from datetime import datetime
 import logging
-from typing import Optional, List, TYPE_CHECKING, Tuple
+from typing import Any, Dict, Optional, List, Set, TYPE_CHECKING, Tuple
 from venv import create
 from mautrix.bridge import portal
 
 # from mausignald import SignaldClient
 # from mausignald.types import (Message, MessageData, Receipt, TypingNotification, OwnReadReceipt,
 #                               Address, ReceiptType)
+from mautrix.types import RoomID
 from mautrix.util.logging import TraceLogger
+from mautrix.util.opt_prometheus import Histogram, async_time
 
-from mautrix_wechat.db import Message as DBMessage
+from mautrix_wechat.db import Message as DBMessage, Portal as DBPortal, Puppet as DBPuppet
 from mautrix_wechat import user as u, portal as po, puppet as pu
+from mautrix_wechat.outbound import OutboundQueue
+from mautrix_wechat.profile_refresh import PRIORITY_BACKGROUND, PuppetProfileRefresher
 from wesdk.client import WechatClient
 from wesdk.types import (
     Message,
@@ -26,10 +30,20 @@ if TYPE_CHECKING:
     from .__main__ import WechatBridge
 
 
+MESSAGE_TIME = Histogram(
+    "bridge_wechat_message_seconds", "Total time spent bridging a message from WeChat", ["type"]
+)
+LOOKUP_TIME = Histogram(
+    "bridge_wechat_message_lookup_seconds", "Time spent finding the sender and portal of a message"
+)
+
+
 class WechatHandler(WechatClient):
     log: TraceLogger = logging.getLogger("mau.wechat")
     loop: asyncio.AbstractEventLoop
     user: Optional[u.User]
+    # Rooms whose membership was checked by a contact sync since the box connected
+    _synced_rooms: Set[RoomID]
 
     def __init__(
         self,
@@ -39,13 +53,20 @@ class WechatHandler(WechatClient):
         bridge: "WechatBridge",
         can_relay: bool = False,
         show_sender: bool = True,
+        outbound: Optional[Dict[str, Any]] = None,
     ) -> None:
         self.admin = admin
         self.log = self.log.getChild(f"{ip}:{port}")
         super().__init__(ip, port, self.log, bridge.loop)
+        self.config = bridge.config
         self.user = None
         self.can_relay = can_relay
         self.show_sender = show_sender
+        self._contact_sync_task = None
+        self._provision_task = None
+        self._synced_rooms = set()
+        self.profile_refresher = PuppetProfileRefresher(self)
+        self.outbound = OutboundQueue(self, outbound)
 
     async def start(self) -> None:
         await self.connect()
@@ -62,10 +83,36 @@ class WechatHandler(WechatClient):
     async def stop(self) -> None:
         await self.disconnect()
 
+    async def disconnect(self) -> None:
+        if self._contact_sync_task:
+            self._contact_sync_task.cancel()
+            self._contact_sync_task = None
+        if self._provision_task:
+            self._provision_task.cancel()
+            self._provision_task = None
+        self.profile_refresher.stop()
+        self.outbound.stop()
+        await super().disconnect()
+
+    async def on_connect(self) -> None:
+        await super().on_connect()
+        self._synced_rooms.clear()
+        self.outbound.on_connect()
+
+    async def on_disconnect(self) -> None:
+        await super().on_disconnect()
+        self.outbound.on_disconnect()
+
+    def get_contact(self, wxid: WechatID) -> Optional[WechatUser]:
+        return self._contact_list.get(wxid)
+
     async def _fetch_info(self, manual: bool = False) -> None:
         try:
             if manual or await self.fetch_personal_info():
                 await self.fetch_contact_list()
+                sync_interval = self.config.snapshot.bridge.contact_sync_interval
+                if sync_interval > 0 and not self._contact_sync_task:
+                    self._contact_sync_task = self.loop.create_task(self._sync_contacts_loop())
         except asyncio.TimeoutError as e:
             self.logger.info("Fetch info timeout, trying again in 5 seconds...")
             await asyncio.sleep(5)
@@ -92,7 +139,7 @@ class WechatHandler(WechatClient):
                     info.wxcode,
                 )
                 await user.insert()
-                user._postinit()
+                user = user._postinit()
                 self.log.debug(f"Created user for {info.wxid}")
             else:
                 user.mxid = self.admin
@@ -106,75 +153,115 @@ class WechatHandler(WechatClient):
             return False
         return True
 
+    async def _sync_contacts_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.snapshot.bridge.contact_sync_interval)
+            try:
+                await self.fetch_contact_list()
+            except Exception:
+                self.log.exception("Failed to sync contact list")
+
     async def fetch_contact_list(self) -> None:
         users = await self.get_contact_list()
         try:
             await self.fetch_chatroom_members()
         except asyncio.exceptions.TimeoutError:
             pass
-        for user in users:
-            if user.wxid.endswith("chatroom"):
-                portal = await po.Portal.get_by_wxid(user.wxid, self.wx_id)
-                if not portal:
-                    try:
-                        portal = po.Portal(
-                            user.wxid, receiver=self.wx_id, name=user.name
-                        )
-                        await portal.insert()
-                        await portal._postinit()
-                        if self.can_relay:
-                            await portal.set_relay_user(self.user)
-                        self.log.debug(f"Created portal for {user.name} {user.wxid}")
-                    except Exception:
-                        self.log.exception(
-                            f"Fail to create portal for {user.name} {user.wxid}"
-                        )
-                else:
-                    try:
-                        portal: po.Portal
-                        portal.name = user.name
-                        await portal.save()
-                    except Exception:
-                        self.log.exception(
-                            f"Fail to update portal for {user.name} {user.wxid}"
-                        )
-                if portal.mxid:
-                    await portal.update_matrix_room(self.user, user)
-                    if self.can_relay:
-                        await portal.set_relay_user(self.user)
-            else:
-                puppet = await pu.Puppet.get_by_wxid(user.wxid)
-                if not puppet:
-                    try:
-                        puppet = pu.Puppet(
-                            user.wxid,
-                            user.headimg,
-                            user.name,
-                            user.remarks,
-                            user.wxcode,
-                        )
-                        await puppet.insert()
-                        puppet._postinit()
-                        self.log.debug(f"Created puppet for {user.name} {user.wxid}")
-                    except Exception:
-                        self.log.exception(
-                            f"Fail to create puppet for {user.name} {user.wxid}"
-                        )
-                else:
-                    try:
-                        puppet: pu.Puppet
-                        puppet.headimg = user.headimg
-                        puppet.name = user.name
-                        puppet.remarks = user.remarks
-                        puppet.wxcode = user.wxcode
-                        # TODO: saved twice here
-                        await puppet.update_info(wechat_user=user)
-                        await puppet.save()
-                    except Exception:
-                        self.log.exception(
-                            f"Fail to update puppet for {user.name} {user.wxid}"
-                        )
+        await self._sync_portals(users)
+        await self._sync_puppets([user for user in users if not user.is_chatroom])
+
+    async def _sync_portals(self, contacts: List[WechatUser]) -> None:
+        portals = await po.Portal.get_all_by_receiver(self.wx_id)
+        created: List[po.Portal] = []
+        changed: List[po.Portal] = []
+        for info in contacts:
+            portal = portals.get(info.wxid)
+            if not portal:
+                if not info.is_chatroom:
+                    # Private chat portals are only created when a message comes in
+                    continue
+                portal = portals[info.wxid] = po.Portal(
+                    info.wxid, receiver=self.wx_id, name=info.name
+                )
+                created.append(portal)
+            elif not portal.mxid and portal.name != info.name:
+                # Portals with a room get their name updated along with the room below
+                portal.name = info.name
+                changed.append(portal)
+        try:
+            await DBPortal.bulk_upsert(created + changed)
+        except Exception:
+            self.log.exception(f"Failed to save {len(created) + len(changed)} synced portals")
+            return
+        for portal in created:
+            portals[portal.wxid] = await portal._postinit()
+        self.log.debug(f"Created {len(created)} and updated {len(changed)} portals")
 
+        for info in contacts:
+            portal = portals.get(info.wxid)
+            if not portal:
+                continue
+            if self.can_relay and info.is_chatroom:
+                await portal.set_relay_user(self.user)
+            if not portal.mxid:
+                continue
+            # The membership is checked on the first sync after connecting, later syncs only
+            # update rooms whose name or avatar changed
+            if portal.mxid not in self._synced_rooms or portal._info_changed(
+                info, self.user.wxid == portal.wxid
+            ):
+                await portal.update_matrix_room(self.user, info)
+                self._synced_rooms.add(portal.mxid)
+
+        if self.config.snapshot.bridge.room_provisioning.strategy == "eager":
+            missing = [
+                info for info in contacts if info.is_chatroom and not portals[info.wxid].mxid
+            ]
+            if missing and (not self._provision_task or self._provision_task.done()):
+                self._provision_task = self.loop.create_task(self._provision_rooms(missing))
+
+    async def _provision_rooms(self, chatrooms: List[WechatUser]) -> None:
+        self.log.info(f"Creating rooms for {len(chatrooms)} group chats in the background")
+        semaphore = asyncio.Semaphore(self.config.snapshot.bridge.room_provisioning.concurrency)
+        delay = self.config.snapshot.bridge.room_provisioning.delay
+
+        async def provision(info: WechatUser) -> None:
+            async with semaphore:
+                # Look the portal up again, it may have been evicted from the cache meanwhile
+                portal = await po.Portal.get_by_wxid(info.wxid, self.wx_id)
+                if portal and not portal.mxid:
+                    await portal.create_matrix_room(self.user, info)
+                    await asyncio.sleep(delay)
+
+        await asyncio.gather(*(provision(info) for info in chatrooms))
+        self.log.info(f"Finished creating rooms for {len(chatrooms)} group chats")
+
+    async def _sync_puppets(self, contacts: List[WechatUser]) -> None:
+        puppets = await pu.Puppet.get_all()
+        created: List[pu.Puppet] = []
+        changed: List[pu.Puppet] = []
+        for info in contacts:
+            puppet = puppets.get(info.wxid)
+            if not puppet:
+                # The name and avatar are filled in by the profile refresher along with the
+                # Matrix profile
+                puppet = pu.Puppet(info.wxid, remarks=info.remarks, wxcode=info.wxcode)
+                created.append(puppet)
+            elif puppet.update_contact_info(info):
+                changed.append(puppet)
+        try:
+            await DBPuppet.bulk_upsert(created + changed)
+        except Exception:
+            self.log.exception(f"Failed to save {len(created) + len(changed)} synced puppets")
+            return
+        for puppet in created:
+            puppets[puppet.wxid] = puppet._postinit()
+        self.log.debug(f"Created {len(created)} and updated {len(changed)} puppets")
+
+        for info in contacts:
+            self.profile_refresher.schedule(puppets[info.wxid], PRIORITY_BACKGROUND, info)
+
+    @async_time(LOOKUP_TIME)
     async def get_msg_info(self, msg: Message) -> Tuple["pu.Puppet", "po.Portal"]:
         sender: pu.Puppet = await pu.Puppet.get_by_wxid(msg.sender, create=True)
         portal: po.Portal = await po.Portal.get_by_wxid(
@@ -186,44 +273,35 @@ class WechatHandler(WechatClient):
         self.log.error(f"Heart beat timeout, last hear beat: {self.last_heart_beat}")
 
     async def on_txt_message(self, msg: TxtMessage) -> None:
-        self.log.trace(f"Received txt message: {msg}")
+        self.log.trace("Received txt message: %s", msg, extra={"sample": "received"})
         return await self.handle_message(msg)
 
     async def on_at_message(self, msg: TxtMessage) -> None:
-        self.log.trace(f"Received at message: {msg}")
+        self.log.trace("Received at message: %s", msg, extra={"sample": "received"})
         # return await self.handle_message(msg)
 
     async def on_pic_message(self, msg: PicMessage) -> None:
-        self.log.trace(f"Received pic message: {msg}")
+        self.log.trace("Received pic message: %s", msg, extra={"sample": "received"})
         return await self.handle_message(msg)
 
     async def on_txt_cite_message(self, msg: TxtCiteMessage) -> None:
-        self.log.trace(f"Received txt cite message: {msg}")
+        self.log.trace("Received txt cite message: %s", msg, extra={"sample": "received"})
         return await self.handle_message(msg)
 
     async def handle_message(self, msg: Message) -> None:
         try:
-            self.log.info("hi, I'm here")
             sender, portal = await self.get_msg_info(msg)
-            self.log.info("hihi, I'm here")
-        except Exception as e:
-            self.log.exception(f"Error handling message: {msg}", exc_info=True)
+        except Exception:
+            self.log.exception("Error handling message: %s", msg)
             return
 
-        try:
-            await sender.update_info(
-                self._contact_list.get(msg.sender),
-                await self.get_personal_detail(msg.sender),
-                await self.get_user_nick(msg.sender),
-            )
-        except Exception:
-            self.log.exception("Error updating puppet info", exc_info=True)
+        # Profiles are refreshed in the background so they don't delay the message
+        self.profile_refresher.schedule(sender)
 
         try:
-            await portal.handle_message(
-                self.user, sender, msg, self._contact_list.get(msg.source)
-            )
-            if portal.mxid and msg.source in self._contact_list:
-                await portal.update_info(self.user, self._contact_list.get(msg.source))
+            with MESSAGE_TIME.labels(type=type(msg).__name__).time():
+                await portal.handle_message(
+                    self.user, sender, msg, self._contact_list.get(msg.source)
+                )
         except Exception:
             self.log.exception(f"Error handling message: {msg}", exc_info=True)
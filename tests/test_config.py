@@ -0,0 +1,47 @@
+from collections.abc import Mapping
+from pathlib import Path
+
+import pytest
+
+import mautrix_wechat.portal  # noqa: F401  (imports the modules in the bridge's order)
+from mautrix_wechat.config import Config
+
+EXAMPLE_CONFIG = Path(__file__).parent.parent / "mautrix_wechat" / "example-config.yaml"
+
+
+def _load(tmp_path: Path, permissions: str) -> Config:
+    path = tmp_path / "config.yaml"
+    path.write_text(
+        EXAMPLE_CONFIG.read_text().replace(
+            '  permissions:\n    "example.com": "user"\n', f"  permissions:\n{permissions}", 1
+        )
+    )
+    config = Config(str(path), str(tmp_path / "registration.yaml"), str(EXAMPLE_CONFIG))
+    config.load()
+    config.update(save=False)
+    return config
+
+
+def test_identifier_keyed_maps_stay_mappings(tmp_path: Path) -> None:
+    config = _load(tmp_path, "    localhost: admin\n    example: user\n")
+    assert isinstance(config.snapshot.bridge.permissions, Mapping)
+    assert isinstance(config.snapshot.appservice.sqlite.pragmas, Mapping)
+    assert all(isinstance(box, Mapping) for box in config.snapshot.wechat.boxes)
+    assert config.get_permissions("@user:localhost").admin
+    assert config.get_permissions("@user:example").user
+
+
+def test_sections_are_attributes(tmp_path: Path) -> None:
+    config = _load(tmp_path, "    localhost: admin\n")
+    assert config.snapshot.bridge.backfill.missed_message_age == 60
+    assert config.snapshot["wechat.outbound.rate"] == config["wechat.outbound.rate"]
+
+
+def test_env_overrides_inside_lists_need_the_index(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("MAUTRIX_WECHAT_ADMIN", "@everyone:example.com")
+    monkeypatch.setenv("MAUTRIX_WECHAT_WECHAT_BOXES_1_ADMIN", "@admin:example.com")
+    config = _load(tmp_path, "    localhost: admin\n")
+    boxes = config.snapshot.wechat.boxes
+    assert [box["admin"] for box in boxes] == ["@test:example.com", "@admin:example.com"]
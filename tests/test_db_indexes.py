@@ -0,0 +1,55 @@
+import asyncio
+import re
+
+import pytest
+
+from mautrix.util.async_db import Database, Scheme
+
+from mautrix_wechat.db import Message, upgrade_table
+
+# SQLite names the indexes of the primary key and of UNIQUE (mxid, mx_room) itself
+PRIMARY_KEY_INDEX = "sqlite_autoindex_message_1"
+MXID_INDEX = "sqlite_autoindex_message_2"
+
+QUERIES = {
+    "get_by_mxid": (Message.get_by_mxid_query, MXID_INDEX),
+    "get_by_wechat_id": (Message.get_by_wechat_id_query, PRIMARY_KEY_INDEX),
+    "get_last": (Message.get_last_query, "message_mx_room_timestamp_idx"),
+    "get_last_before": (Message.get_last_before_query, "message_mx_room_timestamp_idx"),
+    "find_by_sender_content": (
+        Message.find_by_sender_content_query,
+        "message_sender_timestamp_idx",
+    ),
+    "find_by_timestamps": (
+        Message.find_by_timestamps_query(Scheme.SQLITE, 3),
+        "message_timestamp_idx",
+    ),
+    "prune": (Message.prune_query, "message_timestamp_idx"),
+}
+
+
+async def _query_plans() -> dict:
+    db = Database.create("sqlite:///:memory:", upgrade_table=upgrade_table)
+    await db.start()
+    try:
+        plans = {}
+        for name, (query, _) in QUERIES.items():
+            params = max(int(n) for n in re.findall(r"\$(\d+)", query))
+            rows = await db.fetch(f"EXPLAIN QUERY PLAN {query}", *([1] * params))
+            plans[name] = " / ".join(row["detail"] for row in rows)
+        return plans
+    finally:
+        await db.stop()
+
+
+@pytest.fixture(scope="module")
+def plans() -> dict:
+    return asyncio.run(_query_plans())
+
+
+@pytest.mark.parametrize("name", QUERIES)
+def test_message_lookup_uses_index(plans: dict, name: str) -> None:
+    _, index = QUERIES[name]
+    # Matches both "USING INDEX" and "USING COVERING INDEX"
+    assert f"INDEX {index} " in f"{plans[name]} ", plans[name]
+    assert "SCAN message" not in plans[name], plans[name]
@@ -0,0 +1,35 @@
+import asyncio
+
+from mautrix.util.async_db import Database
+
+from mautrix_wechat.db import Message, init, upgrade_table
+
+
+def _message(i: int, timestamp: int) -> Message:
+    return Message(
+        mxid=f"$event{i}",
+        mx_room="!room:example.com",
+        id=str(i),
+        sender="wxid_sender",
+        source="wxid_chat",
+        receiver="wxid_receiver",
+        timestamp=timestamp,
+    )
+
+
+async def _get_last(before: int) -> Message:
+    db = Database.create("sqlite:///:memory:", upgrade_table=upgrade_table)
+    await db.start()
+    init(db)
+    try:
+        await Message.insert_many([_message(1, 100), _message(2, 200), _message(3, 300)])
+        return await Message.get_last("!room:example.com", before)
+    finally:
+        await db.stop()
+
+
+def test_get_last_before_skips_newer_messages() -> None:
+    # Missed messages sent at 250 are inserted after the message sent at 200, not after 300
+    assert asyncio.run(_get_last(250)).mxid == "$event2"
+    assert asyncio.run(_get_last(300)).mxid == "$event3"
+    assert asyncio.run(_get_last(50)) is None
@@ -0,0 +1,91 @@
+import asyncio
+from types import SimpleNamespace
+
+import mautrix_wechat.portal  # noqa: F401  (imports the modules in the bridge's order)
+from mautrix_wechat.outbound import PRIORITY_RELAY, OutboundMessage, OutboundQueue
+from mautrix_wechat.routing import RelayRouter
+
+CHAT = "12345678@chatroom"
+
+
+class FakeHandler:
+    box = "127.0.0.1:5556"
+    connected = True
+
+    def __init__(self, wx_id: str) -> None:
+        self.wx_id = wx_id
+        self.sent = []
+        outbound = SimpleNamespace(max_retries=0, retry_delay=0, rate=0, burst=1)
+        self.config = SimpleNamespace(
+            snapshot=SimpleNamespace(wechat=SimpleNamespace(outbound=outbound)),
+            add_reload_listener=lambda listener: None,
+        )
+
+    async def send_msg(self, text: str, *args, **kwargs) -> dict:
+        self.sent.append(text)
+        return {}
+
+
+def _portal(router: RelayRouter, receiver: str) -> SimpleNamespace:
+    bridge = SimpleNamespace(relay_router=router)
+    return SimpleNamespace(wxid=CHAT, receiver=receiver, bridge=bridge)
+
+
+def _relay(router: RelayRouter, box: FakeHandler, receiver: str, *texts: str) -> None:
+    portal = _portal(router, receiver)
+    msgs = [
+        OutboundMessage(portal, None, f"$event{i}", text, None, PRIORITY_RELAY)
+        for i, text in enumerate(texts)
+    ]
+    asyncio.run(OutboundQueue(box)._deliver(msgs))
+
+
+def test_message_routed_through_other_box_is_dropped_once() -> None:
+    router = RelayRouter(None, [])
+    box_b = FakeHandler("wxid_box_b")
+    # Relayed from box A's room, sent through box B because it was less loaded
+    _relay(router, box_b, "wxid_box_a", "hello", "world")
+    assert box_b.sent == ["hello\nworld"]
+
+    # Box A receives the message back from box B's account
+    assert router.is_echo(CHAT, "wxid_box_a", "wxid_box_b", "hello\nworld")
+    # A second identical message is a real one typed on box B's phone
+    assert not router.is_echo(CHAT, "wxid_box_a", "wxid_box_b", "hello\nworld")
+
+
+def test_only_the_portals_own_box_drops_the_echo() -> None:
+    router = RelayRouter(None, [])
+    _relay(router, FakeHandler("wxid_box_b"), "wxid_box_a", "hello")
+    assert not router.is_echo(CHAT, "wxid_box_c", "wxid_box_b", "hello")
+    assert not router.is_echo(CHAT, "wxid_box_a", "wxid_box_c", "hello")
+    assert not router.is_echo(CHAT, "wxid_box_a", "wxid_box_b", "something else")
+    # Mentions come back with the mention in front
+    assert router.is_echo(CHAT, "wxid_box_a", "wxid_box_b", "@someone hello")
+
+
+def test_messages_sent_through_the_portals_own_box_are_not_tracked() -> None:
+    router = RelayRouter(None, [])
+    _relay(router, FakeHandler("wxid_box_a"), "wxid_box_a", "hello")
+    assert not router.is_echo(CHAT, "wxid_box_a", "wxid_box_a", "hello")
+
+
+def test_only_messages_for_the_same_portal_are_coalesced() -> None:
+    router = RelayRouter(None, [])
+    settings = {"coalesce_window": 1, "coalesce_max_messages": 10, "coalesce_max_length": 1000}
+    queue = OutboundQueue(FakeHandler("wxid_box_b"), settings)
+    # Box A's and box C's portals for the same chat both relay through box B
+    receivers = ["wxid_box_a", "wxid_box_a", "wxid_box_c", "wxid_box_a"]
+    for i, receiver in enumerate(receivers):
+        portal = _portal(router, receiver)
+        queue._push(
+            OutboundMessage(portal, None, f"$event{i}", f"text{i}", None, PRIORITY_RELAY, None, i)
+        )
+    batches = []
+    while queue._queue:
+        msgs = [item[3] for item in asyncio.run(queue._take())]
+        batches.append([msg.event_id for msg in msgs])
+        asyncio.run(queue._deliver(msgs))
+    # Box C's message splits box A's, so that the chat gets them in order
+    assert batches == [["$event0", "$event1"], ["$event2"], ["$event3"]]
+    assert router.is_echo(CHAT, "wxid_box_a", "wxid_box_b", "text0\ntext1")
+    assert router.is_echo(CHAT, "wxid_box_c", "wxid_box_b", "text2")
@@ -2,6 +2,7 @@ from asyncio import futures
 import os
 import sys
 import json
+import time
 import asyncio
 import logging
 from pathlib import Path
@@ -11,7 +12,7 @@ from uuid import uuid4
 from queue import Queue
 from datetime import datetime, timedelta
 from abc import ABCMeta, abstractmethod
-from typing import Awaitable, Iterable, Optional, Union, Tuple, Dict, List
+from typing import Any, Awaitable, Iterable, Optional, Union, Tuple, Dict, List
 from collections import defaultdict
 from dataclasses import asdict
 
@@ -19,6 +20,7 @@ import aiohttp
 from dateutil import parser
 from websockets import connect, ConnectionClosed
 from mautrix.util.logging import TraceLogger
+from mautrix.util.opt_prometheus import Counter, Gauge, Histogram
 
 from wesdk import query
 from wesdk.image import ImageDecodeError, WechatImageDecoder
@@ -33,6 +35,18 @@ from wesdk.types import (
 )
 
 
+RPC_TIME = Histogram("wesdk_rpc_seconds", "Time until the box answered a request", ["query"])
+RPC_TIMEOUTS = Counter("wesdk_rpc_timeouts", "Requests the box didn't answer in time", ["query"])
+PENDING_REQUESTS = Gauge(
+    "wesdk_pending_requests", "Requests waiting for an answer from the box", ["box"]
+)
+RECEIVED_EVENTS = Counter("wesdk_received_events", "Events received from the box", ["type"])
+BOX_CONNECTED = Gauge("wesdk_box_connected", "Whether the box websocket is connected", ["box"])
+BOX_LOGGED_IN = Gauge(
+    "wesdk_box_logged_in", "Whether a WeChat account is logged in on the box", ["box"]
+)
+
+
 def register(q):
     def inner(func):
         func._register = q
@@ -80,7 +94,9 @@ class WechatClient(metaclass=ClientBase):
         self.loop = loop or asyncio.get_event_loop()
         self.session = None
         self.logged_in = False
+        self.connected = False
         self.last_heart_beat = None
+        self.last_heart_beat_at = None
         self.wx_code = None
         self.wx_id = None
         self.wx_name = None
@@ -113,6 +129,9 @@ class WechatClient(metaclass=ClientBase):
 
     async def _run_forever(self) -> None:
         async for ws in connect(f"ws://{self.ip}:{self.port}"):
+            BOX_CONNECTED.labels(box=self.box).set(1)
+            self.connected = True
+            self.loop.create_task(self.on_connect())
             try:
                 while True:
                     recv_task = asyncio.create_task(self._recv(ws))
@@ -124,6 +143,9 @@ class WechatClient(metaclass=ClientBase):
                         task.cancel()
                     await asyncio.sleep(0.1)
             except ConnectionClosed:
+                BOX_CONNECTED.labels(box=self.box).set(0)
+                self.connected = False
+                self.loop.create_task(self.on_disconnect())
                 continue
 
     async def _recv(self, ws) -> None:
@@ -140,6 +162,7 @@ class WechatClient(metaclass=ClientBase):
             except:
                 pass
         resp_type = msg.get("type")
+        RECEIVED_EVENTS.labels(type=str(resp_type)).inc()
         try:
             self.loop.create_task(self.handler_registry[resp_type](self, msg))
         except Exception as e:
@@ -155,7 +178,9 @@ class WechatClient(metaclass=ClientBase):
             else:
                 self.logger.warning(f"Unsupported message {msg} type: {type(msg)}")
 
-    async def send_http(self, uri: str, data: Union[dict, str, bytes]):
+    async def send_http(
+        self, uri: str, data: Union[dict, str, bytes], query_type: Optional[str] = None
+    ):
         if isinstance(data, str) or isinstance(data, bytes):
             data = json.loads(data)
         base_data = {
@@ -169,8 +194,19 @@ class WechatClient(metaclass=ClientBase):
         }
         base_data.update(data)
         url = f"http://{self.ip}:{self.port}/{uri}"
-        resp = await self.session.post(url, json={"para": base_data}, timeout=5)
-        data = json.loads(await resp.text())
+        query_type = query_type or uri.rsplit("/", 1)[-1]
+        pending = PENDING_REQUESTS.labels(box=self.box)
+        pending.inc()
+        start = time.monotonic()
+        try:
+            resp = await self.session.post(url, json={"para": base_data}, timeout=5)
+            data = json.loads(await resp.text())
+        except asyncio.TimeoutError:
+            RPC_TIMEOUTS.labels(query=query_type).inc()
+            raise
+        finally:
+            pending.dec()
+        RPC_TIME.labels(query=query_type).observe(time.monotonic() - start)
         if "content" in data and isinstance(data["content"], str):
             try:
                 data["content"] = json.loads(data["content"])
@@ -194,10 +230,14 @@ class WechatClient(metaclass=ClientBase):
         force_type=None,
     ):
         return await self.send_http(
-            "/api/sendtxtmsg", query.send_msg(msg, wxid, roomid, nickname, force_type)
+            "/api/sendtxtmsg",
+            query.send_msg(msg, wxid, roomid, nickname, force_type),
+            query_type="send_msg",
         )
 
     async def disconnect(self) -> None:
+        BOX_CONNECTED.labels(box=self.box).set(0)
+        self.connected = False
         if self._communicate_task:
             self._communicate_task.cancel()
             self._communicate_task = None
@@ -205,17 +245,46 @@ class WechatClient(metaclass=ClientBase):
             self._check_alive_task.cancel()
             self._check_alive_task = None
 
+    @property
+    def box(self) -> str:
+        return f"{self.ip}:{self.port}"
+
     def getset_future(self, payload: any = None) -> Tuple[str, Awaitable]:
         msg_id = str(uuid4())
         future = self.loop.create_future()
         self._futures[msg_id] = (future, payload)
         return msg_id, future
 
+    async def _wait_for(self, query_type: str, msg_id: str, future: Awaitable) -> Any:
+        pending = PENDING_REQUESTS.labels(box=self.box)
+        pending.inc()
+        start = time.monotonic()
+        try:
+            result = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            RPC_TIMEOUTS.labels(query=query_type).inc()
+            # Nobody is waiting for the answer anymore
+            self._futures.pop(msg_id, None)
+            raise
+        finally:
+            pending.dec()
+        RPC_TIME.labels(query=query_type).observe(time.monotonic() - start)
+        return result
+
+    def box_time(self) -> Optional[datetime]:
+        """Estimate the box's current local time from the last heartbeat."""
+        if self.last_heart_beat is None or self.last_heart_beat_at is None:
+            return None
+        return self.last_heart_beat + timedelta(
+            seconds=time.monotonic() - self.last_heart_beat_at
+        )
+
     @register(query.HEART_BEAT)
     async def handle_heart_beat(self, msg) -> None:
         self.last_heart_beat = (
             parser.parse(msg.get("time")) if msg.get("time") else None
         )
+        self.last_heart_beat_at = time.monotonic()
         await self.on_heart_beat(msg)
 
     @register(query.PERSONAL_DETAIL)
@@ -236,14 +305,15 @@ class WechatClient(metaclass=ClientBase):
         for chat_room in msg.get("content", {}):
             if chat_room_id := chat_room.get("room_id"):
                 if room_id and chat_room_id == room_id:
-                    return future.set_result(
-                        [WechatID(m) for m in chat_room.get("member")]
-                    )
+                    if future:
+                        future.set_result([WechatID(m) for m in chat_room.get("member")])
+                    return
                 elif WechatID(chat_room_id) in self._contact_list:
                     self._contact_list[WechatID(chat_room_id)].chat_room_members = [
                         WechatID(m) for m in chat_room.get("member")
                     ]
-        future.set_result(None)
+        if future:
+            future.set_result(None)
 
     @register(query.CHATROOM_MEMBER_NICK)
     async def handle_chatroom_member_nick(self, msg) -> None:
@@ -278,6 +348,7 @@ class WechatClient(metaclass=ClientBase):
             self.logger.info(
                 f"No account logged in, please go to https://{self.ip}:8080/vnc.html to log in."
             )
+        BOX_LOGGED_IN.labels(box=self.box).set(int(self.logged_in))
         future, _ = self._futures.pop(msg_id, (None, None))
         if future:
             future.set_result(
@@ -394,24 +465,25 @@ class WechatClient(metaclass=ClientBase):
         self.wx_code = wxcode
         self.wx_name = wxname
         self.logged_in = True
+        BOX_LOGGED_IN.labels(box=self.box).set(1)
         self.logger.info(f"Manually login in as user {self.wx_name} ({self.wx_id}).")
 
     async def get_personal_info(self) -> Optional[WechatUser]:
         msg_id, future = self.getset_future()
         self._pending_messages.put(query.get_personal_info(msg_id))
-        return await asyncio.wait_for(future, self.timeout)
+        return await self._wait_for("personal_info", msg_id, future)
 
     async def get_personal_detail(
         self, wxid: Union[str, WechatID]
     ) -> Optional[WechatUserDetail]:
         msg_id, future = self.getset_future()
         self._pending_messages.put(query.get_personal_detail(wxid, msg_id))
-        return await asyncio.wait_for(future, self.timeout)
+        return await self._wait_for("personal_detail", msg_id, future)
 
     async def get_contact_list(self) -> Iterable[WechatUser]:
         msg_id, future = self.getset_future()
         self._pending_messages.put(query.get_contact_list(msg_id))
-        return await asyncio.wait_for(future, self.timeout)
+        return await self._wait_for("contact_list", msg_id, future)
 
     async def get_chatroom_member(
         self, room_id: WechatID
@@ -420,26 +492,26 @@ class WechatClient(metaclass=ClientBase):
         self._pending_messages.put(
             query.get_chatroom_member(roomid=room_id or "null", msg_id=msg_id)
         )
-        return await asyncio.wait_for(future, self.timeout)
+        return await self._wait_for("chatroom_member", msg_id, future)
 
     async def fetch_chatroom_members(self) -> None:
         msg_id, future = self.getset_future(None)
         self._pending_messages.put(
             query.get_chatroom_member("null", msg_id=msg_id)
         )
-        return await asyncio.wait_for(future, self.timeout)
+        return await self._wait_for("chatroom_members", msg_id, future)
 
     async def get_chatroom_member_nick(
         self, room_id: WechatID, wxid: WechatID
     ) -> Optional[ChatRoomNick]:
         msg_id, future = self.getset_future()
         self._pending_messages.put(query.get_chatroom_member_nick(room_id, wxid, msg_id))
-        return await asyncio.wait_for(future, self.timeout)
+        return await self._wait_for("chatroom_member_nick", msg_id, future)
 
     async def get_user_nick(self, wxid: WechatID) -> Optional[ChatRoomNick]:
         msg_id, future = self.getset_future()
         self._pending_messages.put(query.get_user_nick(wxid, msg_id))
-        return await asyncio.wait_for(future, self.timeout)
+        return await self._wait_for("user_nick", msg_id, future)
 
     async def get_user(self, wxid: WechatID) -> WechatUser:
         if wxid in self._contact_list:
@@ -448,7 +520,15 @@ class WechatClient(metaclass=ClientBase):
         return WechatUser("", user_nick.nick, "", "", wxid)
 
     async def on_heart_beat(self, msg) -> None:
-        self.logger.trace(f"Received heart beat: {self.last_heart_beat}")
+        self.logger.trace(
+            "Received heart beat: %s", self.last_heart_beat, extra={"sample": "heart_beat"}
+        )
+
+    async def on_connect(self) -> None:
+        self.logger.info("Connected to box")
+
+    async def on_disconnect(self) -> None:
+        self.logger.warning("Lost connection to box")
 
     async def on_chatroom_member(self, msg) -> None:
         print(f"Received chatroom member: {msg}")